@@ -18,7 +18,7 @@
 ##
 
 from django.apps import AppConfig
-from django.db.models.signals import pre_save
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 
 
 class InboxenConfig(AppConfig):
@@ -26,6 +26,7 @@ class InboxenConfig(AppConfig):
     verbose_name = "Inboxen Core"
 
     def ready(self):
+        from django.contrib.auth import get_user_model
         from django.contrib.auth.models import update_last_login
         from django.contrib.auth.signals import user_logged_in, user_logged_out
         from watson import search as watson_search
@@ -33,15 +34,25 @@ class InboxenConfig(AppConfig):
         from inboxen import checks, search, signals
 
         Inbox = self.get_model("Inbox")
-        Email = self.get_model("Email")
         Request = self.get_model("Request")
+        Body = self.get_model("Body")
+        Domain = self.get_model("Domain")
 
         # Unregister update_last_login handler
         user_logged_in.disconnect(update_last_login)
 
         # Search
-        watson_search.register(Email, search.EmailSearchAdapter)
         watson_search.register(Inbox, search.InboxSearchAdapter)
 
         pre_save.connect(signals.decided_checker, sender=Request, dispatch_uid="request_decided_checker")
+        pre_delete.connect(signals.delete_body_file, sender=Body, dispatch_uid="body_delete_file")
+        post_save.connect(signals.inbox_saved, sender=Inbox, dispatch_uid="inbox_recipient_cache_save")
+        post_delete.connect(signals.inbox_deleted, sender=Inbox, dispatch_uid="inbox_recipient_cache_delete")
+        post_save.connect(signals.clear_search_cache, sender=Inbox, dispatch_uid="inbox_search_cache_save")
+        post_delete.connect(signals.clear_search_cache, sender=Inbox, dispatch_uid="inbox_search_cache_delete")
+        post_save.connect(signals.clear_recipient_cache, sender=Domain, dispatch_uid="domain_recipient_cache_save")
+        post_delete.connect(signals.clear_recipient_cache, sender=Domain, dispatch_uid="domain_recipient_cache_delete")
+        # deleting a user sets Inbox.user to NULL without saving each inbox
+        post_delete.connect(signals.clear_recipient_cache, sender=get_user_model(),
+                            dispatch_uid="user_recipient_cache_delete")
         user_logged_out.connect(signals.logout_message)
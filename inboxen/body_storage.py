@@ -0,0 +1,171 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Storage backends for Body.data
+
+Bodies are content addressed by `Body.hashed`, so a storage backend only
+needs to know how to turn a hash into a place to put bytes.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.utils.encoding import smart_bytes
+from django.utils.module_loading import import_string
+
+
+# group can read, so a web server in the router's group can serve files via sendfile
+DIRECTORY_MODE = 0750
+FILE_MODE = 0640
+
+_storage = None
+_file_storage = None
+
+
+def get_storage():
+    """Returns the configured body storage backend, for storing new bodies"""
+    global _storage
+    if _storage is None:
+        backend = import_string(settings.BODY_STORAGE_BACKEND)
+        _storage = backend(
+            path=settings.BODY_STORAGE_PATH,
+            inline_threshold=settings.BODY_STORAGE_INLINE_THRESHOLD,
+        )
+
+    return _storage
+
+
+def lock_hash(hashed):
+    """Lock `hashed` until the end of the current transaction
+
+    Writing a file for a new Body and deleting the file of a Body that's gone
+    both take this lock, so a file can't be deleted while a Body that needs it
+    is being created
+    """
+    # advisory locks are keyed by a bigint
+    key = int(hashlib.sha1(smart_bytes(hashed)).hexdigest()[:15], 16)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [key])
+
+
+def get_file_storage():
+    """Returns a FileStorage for bodies that are already on disk
+
+    These can still be read after the configured backend has been changed
+    back to "database"
+    """
+    global _file_storage
+    if _file_storage is None:
+        _file_storage = FileStorage(
+            path=settings.BODY_STORAGE_PATH,
+            inline_threshold=settings.BODY_STORAGE_INLINE_THRESHOLD,
+        )
+
+    return _file_storage
+
+
+@receiver(setting_changed)
+def reset_storage(setting, **kwargs):
+    global _storage, _file_storage
+    if setting.startswith("BODY_STORAGE_"):
+        _storage = None
+        _file_storage = None
+
+
+class DatabaseStorage(object):
+    """Keep everything in the database"""
+    def __init__(self, path=None, inline_threshold=None):
+        self.location = path
+        self.inline_threshold = inline_threshold
+
+    def use_file(self, size):
+        """Should a body of this size be stored outside of the database?"""
+        return False
+
+
+class FileStorage(DatabaseStorage):
+    """Store bodies larger than `inline_threshold` on the file system
+
+    Files are sharded by the first few characters of their hash, e.g.
+    "sha1:abcdef..." is stored at "<path>/sha1/ab/cd/abcdef..."
+    """
+    def use_file(self, size):
+        return size > self.inline_threshold
+
+    def path(self, hashed):
+        algo, digest = hashed.split(":", 1)
+        return os.path.join(self.location, algo, digest[:2], digest[2:4], digest)
+
+    def open(self, hashed):
+        return open(self.path(hashed), "rb")
+
+    def read(self, hashed):
+        with self.open(hashed) as body_file:
+            return body_file.read()
+
+    def write(self, hashed, data):
+        """Write data in chunks to a temporary file, then move it into place
+
+        Readers will either see the whole file or no file at all
+        """
+        from inboxen.managers import iter_chunks
+
+        path = self.path(hashed)
+        directory = os.path.dirname(path)
+        self._makedirs(directory)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            # mkstemp only lets the owner read
+            os.fchmod(fd, FILE_MODE)
+            with os.fdopen(fd, "wb") as body_file:
+                for chunk in iter_chunks(data):
+                    body_file.write(chunk)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _makedirs(self, directory):
+        """Like os.makedirs, but new directories get DIRECTORY_MODE whatever
+        the umask is"""
+        if os.path.isdir(directory):
+            return
+
+        parent = os.path.dirname(directory)
+        if parent != directory:
+            self._makedirs(parent)
+
+        try:
+            os.mkdir(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        else:
+            os.chmod(directory, DIRECTORY_MODE)
+
+    def delete(self, hashed):
+        try:
+            os.unlink(self.path(hashed))
+        except OSError:
+            pass
@@ -0,0 +1,46 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Generations for invalidating many cache entries at once
+
+A generation is part of the key (or version) of every entry it covers, so
+changing it makes all of those entries unreachable. Generations are random
+rather than counters: if a counter is evicted it starts again from zero and
+entries from before the eviction come back to life.
+"""
+
+import uuid
+
+from django.core.cache import cache
+
+
+def get_generation(key):
+    """Current generation stored at `key`, one is picked if there isn't one"""
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(key, generation, None):
+            # someone else got there first
+            generation = cache.get(key, generation)
+
+    return generation
+
+
+def bump_generation(key):
+    """Invalidate everything under the generation stored at `key`"""
+    cache.set(key, uuid.uuid4().hex, None)
@@ -0,0 +1,138 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Sanitising of untrusted HTML
+
+Cleaners and XPath expressions are built once, when this module is first
+imported, and shared between calls. None of them keep any state between
+documents.
+"""
+
+from itertools import islice
+import re
+
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+from lxml import etree
+from lxml.html.clean import Cleaner
+from premailer.premailer import Premailer
+
+from redirect import proxy_url
+
+
+HEADER_PARAMS = re.compile(r'([a-zA-Z0-9]+)=["\']?([^"\';=]+)["\']?[;]?')
+
+HTML_SAFE_ATTRS = ["style", "title", "href", "src", "height", "width"]
+
+HTML_ALLOW_TAGS = ["p", "a", "i", "b", "em", "strong", "ol", "ul", "li", "pre",
+    "code", "img", "div", "span", "table", "tr", "th", "td", "thead", "tbody",
+    "tfooter", "br"]
+
+TICKET_SAFE_ATTRS = ["href"]
+
+TICKET_ALLOW_TAGS = ["p", "a", "i", "b", "em", "strong", "ol", "ul", "li", "pre", "code"]
+
+# Mail Pile uses this, give back if you come up with something better
+email_cleaner = Cleaner(
+    allow_tags=HTML_ALLOW_TAGS,
+    kill_tags = ["style"],  # remove style tags, not attrs
+    remove_unknown_tags=False,
+    safe_attrs=HTML_SAFE_ATTRS,
+    safe_attrs_only=True,
+    style=False,  # keep style attrs
+)
+
+ticket_cleaner = Cleaner(
+    allow_tags=TICKET_ALLOW_TAGS,
+    safe_attrs=TICKET_SAFE_ATTRS,
+    remove_unknown_tags=False,
+    safe_attrs_only=True,
+)
+
+_meta_xpath = etree.XPath("/html/head/meta")
+
+# union results come back in document order, so this is a single pass
+_rewrite_xpath = etree.XPath("//img|//a")
+
+
+class InboxenPremailer(Premailer):
+    def _load_external(self, url):
+        """Don't load external resources"""
+        return ""
+
+
+def find_charset(html_tree, charset):
+    """If the HTML doc says its a different encoding, return that, otherwise
+    return `charset`"""
+    for meta_tag in _meta_xpath(html_tree):
+        if meta_tag.get("http-equiv", None) == "Content-Type":
+            content = meta_tag.get("content")
+            try:
+                content = content.split(";", 1)[1]
+                return dict(HEADER_PARAMS.findall(content))["charset"]
+            except (KeyError, IndexError):
+                pass
+        elif meta_tag.get("charset", None):
+            return meta_tag.get("charset")
+
+    return charset
+
+
+def count_elements(html_tree, limit):
+    """Count the elements in `html_tree`, stopping at `limit`"""
+    return sum(1 for element in islice(html_tree.iter(etree.Element), limit))
+
+
+def rewrite_email_tree(html_tree, display_images):
+    """Proxy links and, unless `display_images` is True, replace images with
+    a placeholder
+
+    `html_tree` is modified in place. Returns True if any images were replaced.
+    """
+    has_images = False
+    placeholder = None
+
+    for element in _rewrite_xpath(html_tree):
+        if element.tag == "a":
+            try:
+                # proxy link
+                url = element.attrib["href"]
+                element.attrib["href"] = proxy_url(url)
+            except KeyError:
+                pass
+
+            # open link in tab
+            element.attrib["target"] = "_blank"
+            # and prevent window.opener bug (noopener is only supported in newer
+            # browsers, plus we already set noreferrer in the head)
+            element.attrib["rel"] = "noreferrer"
+        elif not display_images:
+            try:
+                # try to delete src first - we don't want to add a src where there wasn't one already
+                del element.attrib["src"]
+            except KeyError:
+                continue
+
+            if placeholder is None:
+                placeholder = staticfiles_storage.url("imgs/placeholder.svg")
+
+            # replace image with 1px png
+            element.attrib["src"] = placeholder
+            has_images = True
+
+    return has_images
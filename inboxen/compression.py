@@ -0,0 +1,137 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Codecs for compressing Body and HeaderData payloads
+
+Each row records which codec it was stored with, so changing settings only
+affects new rows (or rows rewritten by `manage.py recompress`).
+"""
+
+import base64
+import zlib
+
+from django.conf import settings
+from django.utils.encoding import smart_bytes, smart_text
+
+# codec constants, these are stored in the database so don't change them
+NONE = 0
+ZLIB = 1
+
+CODEC_CHOICES = (
+    (NONE, "none"),
+    (ZLIB, "zlib"),
+)
+
+CODECS = dict((name, value) for value, name in CODEC_CHOICES)
+
+# only compress if it saves at least this much
+MIN_RATIO = 0.9
+
+# how much of a payload to try compressing before deciding if it's worth it
+SAMPLE_SIZE = 2 ** 16
+
+
+def get_codec(data):
+    """Pick a codec for `data` based on settings and how well a sample of it compresses"""
+    codec = CODECS[settings.COMPRESSION_CODEC]
+    if codec == NONE or len(data) < settings.COMPRESSION_MIN_SIZE:
+        return NONE
+
+    sample = data[:SAMPLE_SIZE]
+    if len(zlib.compress(sample)) > len(sample) * MIN_RATIO:
+        # probably already compressed, e.g. an image
+        return NONE
+
+    return codec
+
+
+def encode(data):
+    """Compress `data` if it's worth it. Returns a tuple of (codec, data)"""
+    codec = get_codec(data)
+    if codec == ZLIB:
+        data = zlib.compress(data)
+
+    return codec, data
+
+
+def decode(codec, data):
+    """Decompress `data` that was stored with `codec`"""
+    if codec == ZLIB:
+        return zlib.decompress(data)
+
+    return data
+
+
+def encode_text(data):
+    """Like `encode`, but for text columns
+
+    Compressed data is base64 encoded, so it's only used if it's still
+    smaller than the original
+    """
+    raw = smart_bytes(data)
+    codec, encoded = encode(raw)
+    if codec != NONE:
+        encoded = base64.b64encode(encoded)
+        if len(encoded) < len(raw):
+            return codec, encoded
+
+    return NONE, data
+
+
+def decode_text(codec, data):
+    """Reverse `encode_text`"""
+    if codec == NONE:
+        return data
+
+    return smart_text(decode(codec, base64.b64decode(data)), errors="replace")
+
+
+def compressor(codec):
+    """Returns a function that compresses data chunk by chunk and a function to
+    get the remaining output
+    """
+    if codec == ZLIB:
+        obj = zlib.compressobj()
+        return obj.compress, obj.flush
+
+    return lambda data: data, lambda: ""
+
+
+def iter_decompress(codec, chunks, max_length):
+    """Decompress `chunks` that were stored with `codec`, yielding at most
+    `max_length` bytes at a time
+
+    A small chunk of very compressible data can expand to something huge, so
+    output is limited rather than input
+    """
+    if codec != ZLIB:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    obj = zlib.decompressobj()
+    for chunk in chunks:
+        while chunk:
+            data = obj.decompress(chunk, max_length)
+            if data:
+                yield data
+            chunk = obj.unconsumed_tail
+
+    data = obj.flush()
+    if data:
+        yield data
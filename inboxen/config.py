@@ -45,6 +45,12 @@ cache_dict = {
     "memcached": "django.core.cache.backends.memcached.PyLibMCCache",
 }
 
+# Shorthand for body storage backends
+body_storage_dict = {
+    "database": "inboxen.body_storage.DatabaseStorage",
+    "file": "inboxen.body_storage.FileStorage",
+}
+
 is_testing = int(os.getenv('INBOXEN_TESTING', '0')) > 0
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
@@ -137,6 +143,9 @@ CELERYD_CONCURRENCY = config["tasks"]["concurrency"]
 # Runs tasks synchronously
 CELERY_ALWAYS_EAGER = config["tasks"]["always_eager"]
 
+# Clean up HTML bodies in the background when an email is delivered
+PRERENDER_HTML = config["tasks"]["prerender_html"]
+
 # Path where liberation data is stored
 LIBERATION_PATH = os.path.join(BASE_DIR, config["tasks"]["liberation"]["path"])
 LIBERATION_PATH = LIBERATION_PATH.rstrip("/")
@@ -144,6 +153,51 @@ LIBERATION_PATH = LIBERATION_PATH.rstrip("/")
 # Which method should be used to accelerate liberation data downloads
 SENDFILE_BACKEND = "sendfile.backends.{}".format(config["tasks"]["liberation"]["sendfile_method"])
 
+# Number of router processes to start
+ROUTER_WORKERS = config["router"]["workers"]
+
+# Number of header names, header data and body IDs each router process keeps in memory
+ROUTER_LOOKUP_CACHE_SIZE = config["router"]["lookup_cache_size"]
+
+# Share router lookups between processes via the cache
+ROUTER_LOOKUP_CACHE_SHARED = config["router"]["lookup_cache_shared"]
+
+# Number of seconds to remember if an address can receive mail, 0 to disable
+ROUTER_RECIPIENT_CACHE_TIMEOUT = config["router"]["recipient_cache_timeout"]
+
+# Accept mail to a spool and deliver it to the database in the background
+ROUTER_SPOOL = config["router"]["spool"]
+
+# Number of threads delivering spooled mail
+ROUTER_SPOOL_WORKERS = config["router"]["spool_workers"]
+
+# Number of times to retry delivering spooled mail if there's a database error
+ROUTER_SPOOL_RETRIES = config["router"]["spool_retries"]
+
+# Where email bodies are kept
+BODY_STORAGE_BACKEND = body_storage_dict[config["body_storage"]["backend"]]
+
+# Path where bodies are stored by the "file" backend
+BODY_STORAGE_PATH = os.path.join(BASE_DIR, config["body_storage"]["path"])
+
+# Bodies this size or smaller are always kept in the database
+BODY_STORAGE_INLINE_THRESHOLD = config["body_storage"]["inline_threshold"]
+
+# Codec used to compress new bodies and header data
+COMPRESSION_CODEC = config["compression"]["codec"]
+
+# Don't bother compressing anything smaller than this
+COMPRESSION_MIN_SIZE = config["compression"]["min_size"]
+
+# Don't inline CSS for HTML bodies larger than this
+HTML_CSS_MAX_SIZE = config["html"]["css_max_size"]
+
+# Don't inline CSS for HTML bodies with more elements than this
+HTML_CSS_MAX_NODES = config["html"]["css_max_nodes"]
+
+# Only display the start of HTML bodies larger than this, the rest is rendered by a task on request
+HTML_MAX_SIZE = config["html"]["max_size"]
+
 # Databases!
 DATABASES = {
     'default': {
@@ -0,0 +1,162 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Caches for looking up the primary keys of deduplicated rows
+
+The router looks up the same header names, header data and bodies over and
+over again. Each process keeps a bounded LRU of key -> pk for each model,
+optionally backed by the Django cache so router processes can share.
+
+Rows can be deleted by `inboxen.tasks.clean_orphan_models`, which bumps a
+generation in the Django cache. Caches are cleared when they notice
+the generation has changed.
+"""
+
+from collections import OrderedDict
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.encoding import smart_bytes
+
+from inboxen import cache_generations
+
+
+GENERATION_KEY = "lookup-cache-generation"
+
+_log = logging.getLogger(__name__)
+
+
+def get_generation():
+    return cache_generations.get_generation(GENERATION_KEY)
+
+
+def bump_generation():
+    """Invalidate all lookup caches, in all processes"""
+    cache_generations.bump_generation(GENERATION_KEY)
+
+
+class LookupCache(object):
+    """A bounded LRU cache of key -> primary key for a single model"""
+    def __init__(self, name, size=None, shared=None):
+        self.name = name
+        self.size = settings.ROUTER_LOOKUP_CACHE_SIZE if size is None else size
+        self.shared = settings.ROUTER_LOOKUP_CACHE_SHARED if shared is None else shared
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+    def clear(self):
+        self._data.clear()
+
+    def check_generation(self):
+        """Clear this cache if rows have been deleted since we last looked"""
+        generation = get_generation()
+        if generation != self.generation:
+            if self.generation is not None:
+                _log.debug("Clearing %s lookup cache: %s", self.name, self.stats())
+            self.clear()
+            self.generation = generation
+
+    def _shared_key(self, key):
+        # header names can contain characters memcached won't accept
+        return hashlib.sha1(smart_bytes(key)).hexdigest()
+
+    def _shared_version(self):
+        return "{0}-lookup-{1}".format(self.name, self.generation)
+
+    def _set_local(self, key, value):
+        self._data[key] = value
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def get_many(self, keys):
+        """Returns a dict of key -> pk for keys that are in the cache"""
+        found = {}
+        for key in keys:
+            try:
+                # move key to the end so it's the last to be evicted
+                found[key] = self._data.pop(key)
+                self._data[key] = found[key]
+            except KeyError:
+                pass
+
+        if self.shared:
+            missing = dict((self._shared_key(key), key) for key in keys if key not in found)
+            if len(missing) > 0:
+                shared = cache.get_many(missing.keys(), version=self._shared_version())
+                for shared_key, value in shared.items():
+                    found[missing[shared_key]] = value
+                    self._set_local(missing[shared_key], value)
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        return found
+
+    def set_many(self, items):
+        """Add a dict of key -> pk to the cache"""
+        for key, value in items.items():
+            self._set_local(key, value)
+
+        if self.shared and len(items) > 0:
+            shared = dict((self._shared_key(key), value) for key, value in items.items())
+            cache.set_many(shared, version=self._shared_version(), timeout=None)
+
+    def get_or_create_many(self, queryset, items):
+        """Wraps `get_or_create_many` on a queryset, only querying for items
+        that aren't in the cache
+
+        `items` is either a dict or a set, as `queryset` expects
+        """
+        keys = list(items)
+        found = self.get_many(keys)
+
+        if isinstance(items, dict):
+            missing = dict((key, items[key]) for key in keys if key not in found)
+        else:
+            missing = set(key for key in keys if key not in found)
+
+        if len(missing) > 0:
+            created = queryset.get_or_create_many(missing)
+            # rows could have been created in this transaction, don't cache
+            # them until we know they exist for everyone else too
+            transaction.on_commit(lambda: self.set_many(created))
+            found.update(created)
+
+        return found
+
+
+header_names = LookupCache("headername")
+header_data = LookupCache("headerdata")
+bodies = LookupCache("body")
+
+
+def check_generation():
+    """Check all lookup caches are still valid"""
+    for lookup in (header_names, header_data, bodies):
+        lookup.check_generation()
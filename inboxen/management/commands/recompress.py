@@ -0,0 +1,95 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import IntegerField
+from django.db.models.functions import Coalesce, Length
+
+from inboxen import compression
+from inboxen.models import Body, HeaderData
+
+
+class Command(BaseCommand):
+    help = "Rewrite stored bodies and header data with the configured compression codec"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="rows to rewrite per transaction")
+        parser.add_argument("--batch-bytes", type=int, default=2 ** 26,
+                            help="stop adding rows to a transaction once it has this many bytes of data")
+
+    def handle(self, **options):
+        self.batch_size = options["batch_size"]
+        self.batch_bytes = options["batch_bytes"]
+        self.codec = compression.CODECS[settings.COMPRESSION_CODEC]
+
+        # bodies kept by the storage backend are never compressed
+        bodies = Body.objects.exclude(flags=Body.flags.on_disk)
+        # size is the decompressed size, which is what we'll have in memory
+        size = Coalesce("size", Length("_data"), output_field=IntegerField())
+        count = self._recompress(bodies, size, compression.decode, compression.encode)
+        self.stdout.write("Rewrote {0} bodies".format(count))
+
+        count = self._recompress(HeaderData.objects.all(), Length("_data"), compression.decode_text,
+                                 compression.encode_text)
+        self.stdout.write("Rewrote {0} header data".format(count))
+
+    def _recompress(self, queryset, size, decode, encode):
+        """Walk `queryset` in primary key order, one batch per transaction
+
+        Batches stop at `batch_size` rows or `batch_bytes` of data (as measured
+        by the expression `size`), whichever comes first. A row bigger than
+        `batch_bytes` gets a batch to itself.
+
+        Rows already stored with the configured codec are skipped, as are rows
+        that wouldn't change.
+        """
+        queryset = queryset.exclude(codec=self.codec).only("id", "_data", "codec").order_by("pk")
+        last_pk = 0
+        count = 0
+
+        while True:
+            with transaction.atomic():
+                sizes = queryset.filter(pk__gt=last_pk).annotate(row_size=size).values_list("pk", "row_size")
+                sizes = list(sizes[:self.batch_size])
+                if len(sizes) == 0:
+                    break
+
+                pks = []
+                total = 0
+                for pk, row_size in sizes:
+                    if len(pks) > 0 and total + row_size > self.batch_bytes:
+                        break
+                    pks.append(pk)
+                    total += row_size
+
+                for obj in queryset.filter(pk__in=pks).iterator():
+                    data = decode(obj.codec, obj._data)
+                    if isinstance(data, buffer):
+                        data = str(data)
+
+                    codec, stored = encode(data)
+                    if codec != obj.codec:
+                        queryset.model.objects.filter(pk=obj.pk).update(_data=stored, codec=codec)
+                        count += 1
+
+                last_pk = pks[-1]
+
+        return count
@@ -0,0 +1,122 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from itertools import imap
+import json
+import multiprocessing
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max
+
+from inboxen import search
+from inboxen.models import Email
+
+
+def index_range(id_range):
+    start, end = id_range
+    return start, search.reindex_email_range(start, end)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the search index for emails in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                            help="number of processes to index with")
+        parser.add_argument("--range-size", type=int, default=10000, help="email ids per unit of work")
+        parser.add_argument("--state", default=os.path.join(settings.BASE_DIR, "reindex_state.json"),
+                            help="file to keep progress in, so an interrupted reindex can be resumed")
+        parser.add_argument("--restart", action="store_true", help="ignore any saved progress")
+
+    def handle(self, **options):
+        self.state_path = options["state"]
+        state = None
+        if not options["restart"]:
+            state = self.load_state()
+
+        if state is None:
+            state = {
+                "max_id": Email.objects.aggregate(Max("id"))["id__max"] or 0,
+                "range_size": options["range_size"],
+                "done": [],
+            }
+            self.save_state(state)
+        else:
+            self.stdout.write("Resuming reindex, {0} ranges already done".format(len(state["done"])))
+
+        done = set(state["done"])
+        ranges = []
+        for start in xrange(0, state["max_id"] + 1, state["range_size"]):
+            if start not in done:
+                ranges.append((start, min(start + state["range_size"], state["max_id"] + 1)))
+
+        if options["workers"] > 1:
+            # forked workers must open their own connections
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(options["workers"])
+            results = pool.imap_unordered(index_range, ranges)
+        else:
+            pool = None
+            results = imap(index_range, ranges)
+
+        total = len(done) + len(ranges)
+        started = time.time()
+        count = 0
+        finished = False
+        try:
+            for start, indexed in results:
+                count += indexed
+                done.add(start)
+                state["done"] = sorted(done)
+                self.save_state(state)
+
+                rate = count / max(time.time() - started, 0.001)
+                self.stdout.write("{0}/{1} ranges, {2} emails indexed, {3:.1f} emails/s".format(
+                    len(done), total, count, rate))
+            finished = True
+        finally:
+            if pool is not None:
+                # don't wait for the rest of the work if something went wrong
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+
+        os.unlink(self.state_path)
+        self.stdout.write("Reindex complete")
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except IOError:
+            return None
+
+    def save_state(self, state):
+        # write then rename, so the state file is never half written
+        tmp_path = "{0}.tmp".format(self.state_path)
+        with open(tmp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.rename(tmp_path, self.state_path)
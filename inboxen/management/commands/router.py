@@ -17,8 +17,10 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import glob
 import os
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
 from subprocess import check_output, CalledProcessError
@@ -34,10 +36,14 @@ class Command(BaseCommand):
         self.salmon_bin = os.getenv('SALMON_BIN', 'salmon')
 
         # these need to be ordered from smtp in to database out
+        # "workers" is a glob of extra pidfiles, see router/app/prefork.py
         self.salmon_options = [
-            {'pid': 'run/router.pid', 'boot': 'config.boot'},
+            {'pid': 'run/router.pid', 'boot': 'config.boot', 'workers': 'run/router-*.pid'},
         ]
 
+        if settings.ROUTER_SPOOL:
+            self.salmon_options.append({'pid': 'run/spool.pid', 'boot': 'config.spool'})
+
     def add_arguments(self, parser):
         daemon_parser = parser.add_mutually_exclusive_group(required=True)
         daemon_parser.add_argument("--start", action='store_const', dest="cmd", const=self.salmon_start)
@@ -64,11 +70,19 @@ class Command(BaseCommand):
 
         return output
 
+    def pidfiles(self):
+        """Pidfiles of every process started by salmon_start"""
+        for handler in self.salmon_options:
+            yield handler['pid']
+            if 'workers' in handler:
+                for pid in sorted(glob.glob(os.path.join('router', handler['workers']))):
+                    yield os.path.relpath(pid, 'router')
+
     def salmon_stop(self):
         output = []
-        for handler in self.salmon_options:
+        for pid in self.pidfiles():
             try:
-                output.append(check_output([self.salmon_bin, 'stop', '-pid', handler['pid']], cwd='router'))
+                output.append(check_output([self.salmon_bin, 'stop', '-pid', pid], cwd='router'))
             except CalledProcessError as error:
                 output.append("Exit code %d: %s" % (error.returncode, error.output))
 
@@ -76,9 +90,9 @@ class Command(BaseCommand):
 
     def salmon_status(self):
         output = []
-        for handler in self.salmon_options:
+        for pid in self.pidfiles():
             try:
-                output.append(check_output([self.salmon_bin, 'status', '-pid', handler['pid']], cwd='router'))
+                output.append(check_output([self.salmon_bin, 'status', '-pid', pid], cwd='router'))
             except CalledProcessError as error:
                 output.append("Exit code %d: %s" % (error.returncode, error.output))
 
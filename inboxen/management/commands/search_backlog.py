@@ -0,0 +1,57 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.core.management.base import BaseCommand
+
+from inboxen import search, tasks
+
+
+class Command(BaseCommand):
+    help = "Report on emails that haven't been indexed for search, optionally indexing them"
+
+    def add_arguments(self, parser):
+        action = parser.add_mutually_exclusive_group()
+        action.add_argument("--drain", action="store_true", help="index emails now")
+        action.add_argument("--queue", action="store_true", help="send emails to Celery to be indexed")
+        parser.add_argument("--batch-size", type=int, default=500, help="emails per batch")
+
+    def handle(self, **options):
+        backlog = search.unindexed_emails()
+        self.stdout.write("{0} emails waiting to be indexed".format(backlog.count()))
+
+        if not (options["drain"] or options["queue"]):
+            return
+
+        last_pk = 0
+        count = 0
+        while True:
+            batch = backlog.filter(id__gt=last_pk).order_by("id").values_list("id", flat=True)
+            batch = list(batch[:options["batch_size"]])
+            if len(batch) == 0:
+                break
+
+            if options["queue"]:
+                tasks.index_emails.delay(batch)
+            else:
+                tasks.index_emails(batch)
+
+            last_pk = batch[-1]
+            count += len(batch)
+
+        self.stdout.write("{0} emails {1}".format(count, "queued" if options["queue"] else "indexed"))
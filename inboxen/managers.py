@@ -23,19 +23,83 @@ import hashlib
 import random
 
 from django.conf import settings
-from django.db import IntegrityError, models
+from django.db import IntegrityError, connection, models, transaction
 from django.db.models import Q, Max
 from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
 from django.utils.encoding import smart_bytes
 from django.utils.translation import ugettext as _
 
+from mptt.managers import TreeManager
 from pytz import utc
 
+from inboxen import compression
+from inboxen.body_storage import get_storage
 from inboxen.utils import is_reserved
 
+# see migration 0009
+PARTLIST_TREE_ID_SEQUENCE = "inboxen_partlist_tree_id_seq"
 
-class HashedQuerySet(QuerySet):
+
+class BulkQuerySet(QuerySet):
+    def _get_many(self, field, keys):
+        """Returns a dict of `field` -> pk for rows that already exist"""
+        lookup = "{0}__in".format(field)
+        return dict(self.filter(**{lookup: keys}).values_list(field, "pk"))
+
+    def _create_many(self, field, items):
+        """Insert rows with bulk_create, returns a dict of `field` -> pk"""
+        objs = []
+        for key, kwargs in items.items():
+            kwargs = dict(kwargs)
+            kwargs[field] = key
+            objs.append(self.model(**kwargs))
+
+        try:
+            with transaction.atomic():
+                self.bulk_create(objs)
+        except IntegrityError:
+            # something else inserted some of the same rows, fall back to one
+            # at a time
+            for obj in objs:
+                try:
+                    with transaction.atomic():
+                        obj.save()
+                except IntegrityError:
+                    pass
+
+        return self._get_many(field, items.keys())
+
+    def _get_or_create_many(self, field, items):
+        """Get or create many objects at once, returns a dict of `field` -> pk
+
+        `items` is a dict of unique `field` values -> dict of other model
+        fields. Existing rows are found with a single query and missing rows
+        are inserted with bulk_create.
+        """
+        if len(items) == 0:
+            return {}
+
+        found = self._get_many(field, items.keys())
+        missing = dict((key, value) for key, value in items.items() if key not in found)
+
+        if len(missing) > 0:
+            found.update(self._create_many(field, missing))
+
+        return found
+
+
+def iter_chunks(data, size=None):
+    """Yield `data` in chunks of `size` bytes without copying it"""
+    if size is None:
+        size = settings.BODY_CHUNK_SIZE
+
+    view = memoryview(data)
+    for start in xrange(0, len(data), size):
+        yield view[start:start + size]
+
+
+class HashedQuerySet(BulkQuerySet):
     def hash_it(self, data):
         hashed = hashlib.new(settings.COLUMN_HASHER)
         hashed.update(smart_bytes(data))
@@ -43,6 +107,14 @@ class HashedQuerySet(QuerySet):
 
         return hashed
 
+    def get_or_create_many(self, items):
+        """Get or create objects from a dict of hash -> data
+
+        Returns a dict of hash -> pk
+        """
+        items = {hashed: {"data": data} for hashed, data in items.items()}
+        return self._get_or_create_many("hashed", items)
+
 
 class DomainQuerySet(QuerySet):
     def available(self, user):
@@ -139,6 +211,39 @@ class EmailQuerySet(QuerySet):
         )
 
 
+class PartListManager(TreeManager):
+    def _get_next_tree_id(self):
+        """Take tree_id from a sequence rather than MAX(tree_id) + 1
+
+        Concurrent deliveries can then create new trees without racing each
+        other for the same tree_id
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT nextval(%s)", [PARTLIST_TREE_ID_SEQUENCE])
+            return cursor.fetchone()[0]
+
+    def next_tree_id(self):
+        return self._get_next_tree_id()
+
+    def next_ids(self, count):
+        """Reserve `count` primary keys so a tree can be bulk inserted"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [self.model._meta.db_table, count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class HeaderNameQuerySet(BulkQuerySet):
+    def get_or_create_many(self, names):
+        """Get or create HeaderName objects from an iterable of names
+
+        Returns a dict of name -> pk
+        """
+        return self._get_or_create_many("name", {name: {} for name in names})
+
+
 class HeaderQuerySet(HashedQuerySet):
     def create(self, name=None, data=None, ordinal=None, hashed=None, **kwargs):
         from inboxen.models import HeaderName, HeaderData
@@ -161,15 +266,15 @@ class HeaderQuerySet(HashedQuerySet):
         values = self.filter(query)
 
         if group_by is None:
-            values = values.values_list("name__name", "data__data")
-            return OrderedDict(values)
+            values = values.values_list("name__name", "data___data", "data__codec")
+            return OrderedDict((name, compression.decode_text(codec, data)) for name, data, codec in values)
 
-        values = values.values_list(group_by, "name__name", "data__data")
+        values = values.values_list(group_by, "name__name", "data___data", "data__codec")
 
         headers = OrderedDict()
         for value in values:
             part = headers.get(value[0], OrderedDict())
-            part[value[1]] = value[2]
+            part[value[1]] = compression.decode_text(value[3], value[2])
             headers[value[0]] = part
 
         return headers
@@ -184,3 +289,73 @@ class BodyQuerySet(HashedQuerySet):
             kwargs.pop("defaults")
 
         return super(BodyQuerySet, self).get_or_create(hashed=hashed, defaults={'data': data}, **kwargs)
+
+    def get_or_create_many(self, items):
+        """Get or create Body objects from a dict of hash -> data
+
+        `data` can also be a function that returns the data, it's only called
+        if the hash isn't found. Bodies larger than BODY_CHUNK_SIZE are
+        created one at a time (in chunks, if they're to be kept in the
+        database), so only one of them is in memory at once. Everything else is
+        inserted in one go.
+        """
+        if len(items) == 0:
+            return {}
+
+        found = self._get_many("hashed", items.keys())
+
+        small = {}
+        for hashed, data in items.items():
+            if hashed in found:
+                continue
+
+            if callable(data):
+                data = data()
+
+            if len(data) <= settings.BODY_CHUNK_SIZE:
+                # bulk_create doesn't call save(), so size is set here
+                small[hashed] = {"data": data, "size": len(data)}
+            elif get_storage().use_file(len(data)):
+                found.update(self._create_many("hashed", {hashed: {"data": data, "size": len(data)}}))
+            else:
+                found[hashed] = self._create_chunked(hashed, data)
+
+        if len(small) > 0:
+            found.update(self._create_many("hashed", small))
+
+        return found
+
+    def _create_chunked(self, hashed, data):
+        """Create a Body, uploading data in chunks via a large object
+
+        Data is compressed as it's uploaded, if it's worth compressing.
+
+        Returns the pk of the new Body, or the existing one if something else
+        got there first
+        """
+        codec = compression.get_codec(data)
+        compress, flush = compression.compressor(codec)
+        try:
+            with transaction.atomic():
+                body = self.model(hashed=hashed, size=len(data), codec=codec)
+                body.save()
+
+                connection.ensure_connection()
+                lobj = connection.connection.lobject(0, "wb")
+                try:
+                    for chunk in iter_chunks(data):
+                        lobj.write(compress(chunk.tobytes()))
+                    lobj.write(flush())
+                finally:
+                    lobj.close()
+
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "UPDATE {0} SET data = lo_get(%s) WHERE id = %s".format(self.model._meta.db_table),
+                        [lobj.oid, body.pk],
+                    )
+                    cursor.execute("SELECT lo_unlink(%s)", [lobj.oid])
+
+                return body.pk
+        except IntegrityError:
+            return self.only("id").get(hashed=hashed).pk
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0008_auto_20161018_1137'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [
+                "CREATE SEQUENCE inboxen_partlist_tree_id_seq",
+                "SELECT setval('inboxen_partlist_tree_id_seq', COALESCE(MAX(tree_id), 0) + 1, false) FROM inboxen_partlist",
+            ],
+            "DROP SEQUENCE inboxen_partlist_tree_id_seq",
+        ),
+    ]
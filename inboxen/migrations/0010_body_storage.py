@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import bitfield.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0009_partlist_tree_id_seq'),
+    ]
+
+    operations = [
+        # Body.data became a property, the column stays where it is
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='body',
+                    name='data',
+                ),
+                migrations.AddField(
+                    model_name='body',
+                    name='_data',
+                    field=models.BinaryField(db_column='data', default=b''),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='body',
+            name='flags',
+            field=bitfield.models.BitField((b'on_disk',), default=0),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0010_body_storage'),
+    ]
+
+    operations = [
+        # HeaderData.data became a property, the column stays where it is
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='headerdata',
+                    name='data',
+                ),
+                migrations.AddField(
+                    model_name='headerdata',
+                    name='_data',
+                    field=models.TextField(db_column='data'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='body',
+            name='codec',
+            field=models.PositiveSmallIntegerField(choices=[(0, b'none'), (1, b'zlib')], default=0),
+        ),
+        migrations.AddField(
+            model_name='headerdata',
+            name='codec',
+            field=models.PositiveSmallIntegerField(choices=[(0, b'none'), (1, b'zlib')], default=0),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def delete_watson_entries(apps, schema_editor):
+    """Emails are no longer indexed by watson"""
+    SearchEntry = apps.get_model("watson", "SearchEntry")
+
+    SearchEntry.objects.filter(content_type__app_label="inboxen", content_type__model="email").delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('watson', '0001_initial'),
+        ('inboxen', '0011_compression'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailSearch',
+            fields=[
+                ('email', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_index', serialize=False, to='inboxen.Email')),
+                ('subject', models.TextField()),
+                ('sender', models.TextField()),
+                ('inbox', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inboxen.Inbox')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        # btree_gin lets user_id go into the same GIN index as the tsvector.
+        # Before PostgreSQL 13 creating it needs a superuser, see "Upgrading"
+        # in README.md. Email search is empty until reindex_emails is run.
+        migrations.RunSQL(
+            [
+                "CREATE EXTENSION IF NOT EXISTS btree_gin",
+                "ALTER TABLE inboxen_emailsearch ADD COLUMN vector tsvector NOT NULL",
+                "CREATE INDEX inboxen_emailsearch_user_vector ON inboxen_emailsearch USING gin (user_id, vector)",
+            ],
+            [
+                "DROP INDEX inboxen_emailsearch_user_vector",
+                "ALTER TABLE inboxen_emailsearch DROP COLUMN vector",
+            ],
+        ),
+        migrations.RunPython(delete_watson_entries, migrations.RunPython.noop),
+    ]
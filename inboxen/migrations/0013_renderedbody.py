@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0012_emailsearch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderedBody',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('charset', models.TextField()),
+                ('display_images', models.BooleanField()),
+                ('html', models.TextField()),
+                ('has_images', models.BooleanField(default=False)),
+                ('css_failed', models.BooleanField(default=False)),
+                ('body', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inboxen.Body')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='renderedbody',
+            unique_together=set([('body', 'charset', 'display_images')]),
+        ),
+    ]
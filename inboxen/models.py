@@ -21,7 +21,7 @@ import os.path
 import re
 
 from django.conf import settings
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.utils.encoding import smart_str
 from django.utils.translation import ugettext_lazy as _
 
@@ -29,7 +29,17 @@ from annoying.fields import AutoOneToOneField, JSONField
 from bitfield import BitField
 from mptt.models import MPTTModel, TreeForeignKey
 
-from inboxen.managers import BodyQuerySet, DomainQuerySet, EmailQuerySet, HeaderQuerySet, InboxQuerySet
+from inboxen import compression
+from inboxen.body_storage import get_file_storage, get_storage, lock_hash
+from inboxen.managers import (
+    BodyQuerySet,
+    DomainQuerySet,
+    EmailQuerySet,
+    HeaderNameQuerySet,
+    HeaderQuerySet,
+    InboxQuerySet,
+    PartListManager,
+)
 
 HEADER_PARAMS = re.compile(r'([a-zA-Z0-9]+)=["\']?([^"\';=]+)["\']?[;]?')
 
@@ -213,13 +223,24 @@ class Email(models.Model):
 
         It also annotates objects with useful attributes, such as charset and parent
         (which is a reference to that object in the same queryset rather than a copy as
-        Django would do it)
+        Django would do it). Leaf parts also get filename and size.
+
+        Bodies are selected along with the parts, apart from their data which
+        would be loaded one part at a time, see
+        inboxen.utils.email.load_bodies. Headers for every part are fetched at
+        once, so this takes the same number of queries however many parts
+        there are.
         """
-        part_list = list(self.parts.all())
+        part_list = list(self.parts.select_related("body").defer("body___data"))
+        part_heads = Header.objects.filter(part__email=self).get_many(
+            "Content-Type",
+            "Content-Disposition",
+            group_by="part_id",
+        )
         parents = {}
         for part in part_list:
             part.parent = parents.get(part.parent_id, None)
-            part_head = part.header_set.get_many("Content-Type", "Content-Disposition")
+            part_head = part_heads.get(part.id, {})
             content_header = part_head.pop("Content-Type", "").split(";", 1)
             part.content_type = content_header[0]
             content_params = content_header[1] if len(content_header) > 1 else ""
@@ -239,14 +260,36 @@ class Email(models.Model):
             params.update(dict(HEADER_PARAMS.findall(dispos)))
 
             # find filename, could be anywhere, could be nothing
-            part_head["filename"] = params.get("filename") or params.get("name") or ""
+            part.filename = params.get("filename") or params.get("name") or ""
 
             # grab charset
             part.charset = params.get("charset", "utf-8")
 
+            part.size = part.body.size
+
         return part_list
 
 
+class EmailSearch(models.Model):
+    """Full text search index for an email
+
+    user and inbox are copied from the email's inbox, so a search only needs
+    to look at the user's own rows. There's also a `vector` tsvector column
+    with a GIN index on (user_id, vector), Django doesn't know about it so it's
+    written and queried with SQL, see inboxen.search
+
+    subject and sender are kept for displaying results
+    """
+    email = models.OneToOneField(Email, primary_key=True, related_name="search_index")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, db_index=False)
+    inbox = models.ForeignKey(Inbox)
+    subject = models.TextField()
+    sender = models.TextField()
+
+    def __unicode__(self):
+        return unicode(self.email_id)
+
+
 class Body(models.Model):
     """Body model
 
@@ -254,13 +297,105 @@ class Body(models.Model):
     bodies.
 
     This model expects and returns binary data, converting to and from unicode happens elsewhere
+
+    `data` may be kept in the database or elsewhere, depending on the body
+    storage backend. `flags` are:
+    * "on_disk" means `data` is kept by the storage backend, not `_data`
+
+    `codec` is the compression used on `_data`, `size` is always the
+    uncompressed size
     """
     hashed = models.CharField(max_length=80, unique=True)  # <algo>:<hash>
-    data = models.BinaryField(default="")
+    _data = models.BinaryField(default="", db_column="data")
     size = models.PositiveIntegerField(null=True)
+    flags = BitField(flags=("on_disk",), default=0)
+    codec = models.PositiveSmallIntegerField(choices=compression.CODEC_CHOICES, default=compression.NONE)
 
     objects = BodyQuerySet.as_manager()
 
+    def get_data(self):
+        if self.flags.on_disk:
+            return get_file_storage().read(self.hashed)
+        return compression.decode(self.codec, self._data)
+
+    def set_data(self, data):
+        if not self.hashed:
+            self.hashed = Body.objects.hash_it(data)
+
+        self.size = len(data)
+
+        storage = get_storage()
+        if storage.use_file(self.size):
+            # held until this Body has been committed, see signals.delete_body_file
+            lock_hash(self.hashed)
+            storage.write(self.hashed, data)
+            self.flags.on_disk = True
+            self.codec = compression.NONE
+            self._data = ""
+        else:
+            self.flags.on_disk = False
+            self.codec, self._data = compression.encode(data)
+
+    data = property(get_data, set_data)
+
+    def iter_data(self, start=0, stop=None):
+        """Yield `data` from `start` up to `stop` in chunks, without loading
+        the whole body
+
+        Uncompressed bodies in the database are read with substring(), so only
+        the requested bytes are fetched. Compressed bodies have to be read and
+        decompressed from the beginning, BODY_CHUNK_SIZE bytes at a time (of
+        both input and output).
+        """
+        if stop is None:
+            stop = self.size
+        chunk_size = settings.BODY_CHUNK_SIZE
+
+        if self.flags.on_disk:
+            with get_file_storage().open(self.hashed) as body_file:
+                body_file.seek(start)
+                while start < stop:
+                    chunk = body_file.read(min(chunk_size, stop - start))
+                    if not chunk:
+                        break
+                    start += len(chunk)
+                    yield chunk
+        elif self.codec == compression.NONE:
+            for chunk in self._iter_stored(start, stop, chunk_size):
+                yield chunk
+        else:
+            position = 0
+            stored = self._iter_stored(0, None, chunk_size)
+            for chunk in compression.iter_decompress(self.codec, stored, chunk_size):
+                if position + len(chunk) > start:
+                    yield chunk[max(start - position, 0):stop - position]
+                position += len(chunk)
+                if position >= stop:
+                    return
+
+    def _iter_stored(self, start, stop, chunk_size):
+        """Read `_data` from `start` to `stop` (or the end, if `stop` is
+        None) straight from the database"""
+        while stop is None or start < stop:
+            length = chunk_size if stop is None else min(chunk_size, stop - start)
+            with connection.cursor() as cursor:
+                # substring() counts from 1
+                cursor.execute("SELECT substring(data from %s for %s) FROM inboxen_body WHERE id = %s",
+                               [start + 1, length, self.id])
+                chunk = str(cursor.fetchone()[0])
+
+            if not chunk:
+                break
+            start += len(chunk)
+            yield chunk
+
+    @property
+    def path(self):
+        """Path to the file containing this body, if there is one"""
+        if self.flags.on_disk:
+            return get_file_storage().path(self.hashed)
+        return None
+
     def save(self, *args, **kwargs):
         if self.size is None:
             self.size = len(self.data)
@@ -270,6 +405,27 @@ class Body(models.Model):
         return self.hashed
 
 
+class RenderedBody(models.Model):
+    """Cleaned up HTML for a Body, see inboxen.utils.email
+
+    There can be one for each charset and display_images setting a body has
+    been rendered with. has_images and css_failed are as returned by
+    `_clean_html`
+    """
+    body = models.ForeignKey(Body)
+    charset = models.TextField()
+    display_images = models.BooleanField()
+    html = models.TextField()
+    has_images = models.BooleanField(default=False)
+    css_failed = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (("body", "charset", "display_images"),)
+
+    def __unicode__(self):
+        return u"{0} ({1})".format(self.body_id, self.charset)
+
+
 class PartList(MPTTModel):
     """Part model
 
@@ -283,6 +439,8 @@ class PartList(MPTTModel):
     body = models.ForeignKey(Body, on_delete=models.PROTECT)
     parent = TreeForeignKey('self', null=True, blank=True, related_name='children')
 
+    objects = PartListManager()
+
     def __unicode__(self):
         return unicode(self.id)
 
@@ -294,6 +452,8 @@ class HeaderName(models.Model):
     """
     name = models.CharField(max_length=78, unique=True)
 
+    objects = HeaderNameQuerySet.as_manager()
+
     def __unicode__(self):
         return self.name
 
@@ -302,9 +462,20 @@ class HeaderData(models.Model):
     """Header data model
 
     RFC 2822 implies that header data may be infinite, may as well support it!
+
+    `codec` is the compression used on `_data`, see inboxen.compression
     """
     hashed = models.CharField(max_length=80, unique=True)  # <algo>:<hash>
-    data = models.TextField()
+    _data = models.TextField(db_column="data")
+    codec = models.PositiveSmallIntegerField(choices=compression.CODEC_CHOICES, default=compression.NONE)
+
+    def get_data(self):
+        return compression.decode_text(self.codec, self._data)
+
+    def set_data(self, data):
+        self.codec, self._data = compression.encode_text(data)
+
+    data = property(get_data, set_data)
 
     def __unicode__(self):
         return self.hashed
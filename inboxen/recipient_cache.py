@@ -0,0 +1,74 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Cache of which addresses can receive email
+
+Most mail to addresses that don't exist is spam, so the router checks here
+before going anywhere near the database. Both positive and negative answers
+are cached for ROUTER_RECIPIENT_CACHE_TIMEOUT seconds.
+
+Entries for an inbox are updated when it is saved or deleted. Changes that
+could affect many inboxes (e.g. a domain being disabled) bump a generation
+instead, which invalidates every entry at once.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_bytes
+
+from inboxen import cache_generations
+
+
+GENERATION_KEY = "recipient-cache-generation"
+
+
+def _key(inbox, domain):
+    # addresses come from the SMTP envelope, which could contain anything
+    return hashlib.sha1(smart_bytes(u"{0}@{1}".format(inbox, domain))).hexdigest()
+
+
+def _version():
+    return "recipient-{0}".format(cache_generations.get_generation(GENERATION_KEY))
+
+
+def bump_generation():
+    """Invalidate the whole cache"""
+    cache_generations.bump_generation(GENERATION_KEY)
+
+
+def set_receiving(inbox, domain, receiving):
+    timeout = settings.ROUTER_RECIPIENT_CACHE_TIMEOUT
+    if timeout > 0:
+        cache.set(_key(inbox, domain), receiving, timeout, version=_version())
+
+
+def is_receiving(inbox, domain):
+    """Returns True if inbox@domain can receive email"""
+    from inboxen.models import Inbox
+
+    if settings.ROUTER_RECIPIENT_CACHE_TIMEOUT > 0:
+        receiving = cache.get(_key(inbox, domain), version=_version())
+        if receiving is not None:
+            return receiving
+
+    receiving = Inbox.objects.filter(inbox=inbox, domain__domain=domain).receiving().exists()
+    set_receiving(inbox, domain, receiving)
+
+    return receiving
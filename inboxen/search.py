@@ -17,118 +17,312 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+from functools import partial
+from itertools import islice
+import logging
 import re
 
-from django.core import exceptions
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
 from django.utils import encoding
 
 from watson import search
 
+from inboxen import compression, search_cache
+
 
 HEADER_PARAMS = re.compile(r'([a-zA-Z0-9]+)=["\']?([^"\';=]+)["\']?[;]?')
 
+# number of emails to prefetch and index at once
+INDEX_BATCH_SIZE = 100
 
-class EmailSearchAdapter(search.SearchAdapter):
-    trunc_to_size = 2 ** 20  # 1MB. Or two copies of 1984
+# Postgres text search configuration for the email index
+SEARCH_CONFIG = "pg_catalog.english"
 
-    def get_bodies(self, obj):
-        """Return a queryset of text/* bodies for given obj"""
-        from inboxen.models import Body
+# number of emails on a page of search results
+SEARCH_PAGE_SIZE = 10
 
-        data = Body.objects.filter(
-            partlist__email__id=obj.id,
-            partlist__header__name__name="Content-Type",
-            partlist__header__data__data__startswith="text/",
-        )
+# subject is weighted above the sender, which is weighted above the body
+INDEX_ROW = "(%s, %s, %s, %s, %s, setweight(to_tsvector(%s, %s), 'A') || " \
+    "setweight(to_tsvector(%s, %s), 'B') || setweight(to_tsvector(%s, %s), 'D'))"
 
-        if len(data) == 0:
-            data = Body.objects.filter(partlist__email__id=obj.id)
-            data = data.exclude(partlist__header__name__name="Content-Type")
-            data = data.exclude(partlist__header__name__name="MIME-Version")
+_log = logging.getLogger(__name__)
 
-        return data
 
-    def get_body_charset(self, obj, body):
-        """Figure out the charset for the body we've just been given"""
-        from inboxen.models import Header
+def index_emails(emails):
+    """Build or replace search index rows for `emails`
 
-        content_type = Header.objects.filter(part__email__id=obj.id, part__body__id=body.id, name__name="Content-Type").select_related("data")
-        try:
-            content_type = content_type[0].data.data
-            content_type = content_type.split(";", 1)
-            params = dict(HEADER_PARAMS.findall(content_type[1]))
-            encoding = params["charset"]
-        except (exceptions.ObjectDoesNotExist, IndexError, KeyError):
-            encoding = "utf-8"
+    Emails are indexed in batches, each batch takes the same number of queries
+    however many emails are in it. Emails should have inbox selected already.
+    Emails in inboxes that no longer have a user are skipped.
 
-        return encoding
+    If Postgres rejects a batch (e.g. an email makes a tsvector that's too
+    big), its emails are retried one at a time and the ones that still fail
+    are logged and skipped, so one bad email can't stop the others being
+    indexed.
+    """
+    from inboxen.models import Email, EmailSearch
 
-    # Overridden SearchAdapter methods, see Watson docs
+    adapter = EmailSearchAdapter(Email)
+    emails = iter(emails)
 
-    def get_title(self, obj):
-        """Fetch subject for obj"""
-        from inboxen.models import HeaderData
+    while True:
+        batch = list(islice(emails, INDEX_BATCH_SIZE))
+        if len(batch) == 0:
+            break
+
+        batch = [email for email in batch if email.inbox.user_id is not None]
+        if len(batch) == 0:
+            continue
+
+        adapter.prefetch(batch)
+
+        rows = []
+        for email in batch:
+            # Postgres won't store NUL in text columns
+            subject = adapter.get_title(email).replace(u"\x00", u"")
+            sender = adapter.get_sender(email).replace(u"\x00", u"")
+            rows.append((email, [
+                email.id,
+                email.inbox.user_id,
+                email.inbox_id,
+                subject,
+                sender,
+                SEARCH_CONFIG,
+                subject,
+                SEARCH_CONFIG,
+                sender,
+                SEARCH_CONFIG,
+                adapter.get_content(email).replace(u"\x00", u""),
+            ]))
 
         try:
-            subject = HeaderData.objects.filter(
-                header__part__parent__isnull=True,
-                header__name__name="Subject",
-                header__part__email__id=obj.id,
+            _insert_index_rows(EmailSearch, rows)
+        except DatabaseError:
+            for row in rows:
+                try:
+                    _insert_index_rows(EmailSearch, [row])
+                except DatabaseError:
+                    _log.exception("Couldn't index email %s, skipping it", row[0].id)
+
+
+def _insert_index_rows(model, rows):
+    """Replace index rows, `rows` is a list of (email, INDEX_ROW params)"""
+    with transaction.atomic():
+        model.objects.filter(email_id__in=[email.id for email, params in rows]).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {0} (email_id, user_id, inbox_id, subject, sender, vector) VALUES {1}".format(
+                    model._meta.db_table,
+                    ", ".join([INDEX_ROW] * len(rows)),
+                ),
+                [param for email, params in rows for param in params],
             )
-            subject = subject[0]
 
-            return encoding.smart_text(subject.data, errors='replace')
-        except IndexError:
-            return u""
+        for user_id in set(email.inbox.user_id for email, params in rows):
+            transaction.on_commit(partial(search_cache.bump_generation, user_id))
 
-    def get_description(self, obj):
-        """Fetch first text/* body for obj, reading up to `trunc_to_size` bytes
+
+def search_emails(user_id, term, after=None, limit=SEARCH_PAGE_SIZE):
+    """Search emails `user_id` can view for `term`, best matches first
+
+    Only the user's own rows are looked at, thanks to the (user_id, vector)
+    index. Returns a tuple of (email ids, cursor). Pass the cursor back as
+    `after` to get the next page, it's None if there are no more results.
+    """
+    from inboxen.models import Email, EmailSearch, Inbox
+
+    table = EmailSearch._meta.db_table
+    # real doesn't survive a round trip through text before PostgreSQL 12,
+    # numeric does so the cursor compares exactly with what was selected
+    rank = "ts_rank({0}.vector, plainto_tsquery(%s, %s))::numeric".format(table)
+    results = EmailSearch.objects.filter(user_id=user_id).exclude(
+        Q(email__flags=Email.flags.deleted) |
+        Q(inbox__flags=Inbox.flags.deleted),
+    )
+    results = results.extra(
+        select={"rank": rank},
+        select_params=[SEARCH_CONFIG, term],
+        where=["{0}.vector @@ plainto_tsquery(%s, %s)".format(table)],
+        params=[SEARCH_CONFIG, term],
+    )
+
+    if after is not None:
+        last_rank, last_id = parse_cursor(after)
+        results = results.extra(
+            where=["({0}, {1}.email_id) < (%s::numeric, %s)".format(rank, table)],
+            params=[SEARCH_CONFIG, term, last_rank, last_id],
+        )
+
+    # get one more than we need to see if there's another page
+    results = list(results.order_by("-rank", "-email_id").values_list("email_id", "rank")[:limit + 1])
+
+    cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        cursor = make_cursor(*results[-1])
+
+    return [result[0] for result in results], cursor
+
+
+def make_cursor(email_id, rank):
+    """Make a cursor for the page after a result, `rank` is a Decimal"""
+    return "{0}:{1}".format(rank, email_id)
+
+
+def parse_cursor(cursor):
+    """Returns a tuple of (rank, email id), raises ValueError if `cursor`
+    isn't valid
+    """
+    rank, email_id = cursor.split(":", 1)
+    try:
+        rank = Decimal(rank)
+    except InvalidOperation:
+        raise ValueError("Invalid rank: {0}".format(rank))
+
+    if not rank.is_finite():
+        raise ValueError("Invalid rank: {0}".format(rank))
+
+    return rank, int(email_id)
+
+
+def unindexed_emails():
+    """Returns a QuerySet of emails that should be in the search index but
+    aren't yet
+    """
+    from inboxen.models import Email
+
+    return Email.objects.filter(search_index__isnull=True, inbox__user__isnull=False)
+
+
+def reindex_email_range(start, end):
+    """Rebuild index rows for emails with `start` <= id < `end`
+
+    Rows are replaced in one transaction, so searches carry on working while a
+    reindex is running. Returns the number of emails indexed.
+    """
+    from inboxen.models import Email
+
+    with transaction.atomic():
+        emails = Email.objects.filter(id__gte=start, id__lt=end).select_related("inbox")
+        emails = list(emails.order_by("id"))
+        index_emails(emails)
+
+    return len(emails)
+
+
+class EmailSearchAdapter(search.SearchAdapter):
+    trunc_to_size = 2 ** 20  # 1MB. Or two copies of 1984
+
+    # headers needed to index an email
+    prefetch_headers = ("Subject", "From", "Content-Type", "MIME-Version")
+
+    def prefetch(self, objs):
+        """Load everything needed to index `objs` in three queries
+
+        Results are kept on each object as `_search_data`, the other methods
+        call this for single objects if it's not been done already.
+
+        Bodies are text/* parts. If there are none, parts without Content-Type
+        or MIME-Version headers are used instead. Only enough bodies to fill
+        `trunc_to_size` are loaded.
         """
+        from inboxen.models import Body, Header, PartList
+
+        emails = {}
+        for obj in objs:
+            obj._search_data = {"subject": u"", "from": u"", "bodies": []}
+            emails[obj.id] = obj
+
+        headers = Header.objects.filter(part__email__id__in=emails.keys(), name__name__in=self.prefetch_headers)
+        headers = headers.order_by("ordinal").values_list("part_id", "name__name", "data___data", "data__codec")
+        part_headers = {}
+        for part_id, name, data, codec in headers:
+            # first header wins
+            if name not in part_headers.setdefault(part_id, {}):
+                part_headers[part_id][name] = compression.decode_text(codec, data)
+
+        parts = PartList.objects.filter(email__id__in=emails.keys()).order_by("tree_id", "lft")
+        parts = parts.values_list("id", "email_id", "parent_id", "body_id", "body__size")
+
+        text_bodies = {}
+        other_bodies = {}
+        for part_id, email_id, parent_id, body_id, size in parts:
+            headers = part_headers.get(part_id, {})
+            if parent_id is None:
+                emails[email_id]._search_data["subject"] = headers.get("Subject", u"")
+                emails[email_id]._search_data["from"] = headers.get("From", u"")
+
+            content_type = headers.get("Content-Type")
+            if content_type is not None and content_type.startswith("text/"):
+                bodies = text_bodies.setdefault(email_id, OrderedDict())
+            elif content_type is None and "MIME-Version" not in headers:
+                bodies = other_bodies.setdefault(email_id, OrderedDict())
+            else:
+                continue
+
+            if body_id not in bodies:
+                bodies[body_id] = (size, self.get_charset(content_type))
+
+        wanted = {}
+        for email_id in emails:
+            total = 0
+            bodies = text_bodies.get(email_id) or other_bodies.get(email_id) or {}
+            for body_id, (size, charset) in bodies.items():
+                if total >= self.trunc_to_size:
+                    break
+                wanted.setdefault(email_id, []).append((body_id, charset))
+                total += size
+
+        body_ids = set(body_id for bodies in wanted.values() for body_id, charset in bodies)
+        loaded = Body.objects.in_bulk(body_ids)
+        for email_id, bodies in wanted.items():
+            emails[email_id]._search_data["bodies"] = [(loaded[body_id], charset) for body_id, charset in bodies]
+
+    def get_charset(self, content_type):
+        """Figure out the charset from a Content-Type header"""
         try:
-            body = self.get_bodies(obj)[0]
-        except IndexError:
-            return u""
+            params = dict(HEADER_PARAMS.findall(content_type.split(";", 1)[1]))
+            return params["charset"]
+        except (AttributeError, IndexError, KeyError):
+            return "utf-8"
+
+    def get_search_data(self, obj):
+        if not hasattr(obj, "_search_data"):
+            self.prefetch([obj])
+
+        return obj._search_data
 
-        return encoding.smart_text(body.data[:self.trunc_to_size], encoding=self.get_body_charset(obj, body), errors='replace')
+    def get_sender(self, obj):
+        """Fetch From header for obj"""
+        return encoding.smart_text(self.get_search_data(obj)["from"], errors='replace')
+
+    # Overridden SearchAdapter methods, see Watson docs
+
+    def get_title(self, obj):
+        """Fetch subject for obj"""
+        return encoding.smart_text(self.get_search_data(obj)["subject"], errors='replace')
 
     def get_content(self, obj):
         """Fetch all text/* bodies for obj, reading up to `trunc_to_size` bytes"""
         data = []
         size = 0
-        for body in self.get_bodies(obj):
+        for body, charset in self.get_search_data(obj)["bodies"]:
             remains = self.trunc_to_size - size
             size = size + body.size
 
             if remains <= 0:
                 break
             elif remains < body.size:
-                data.append(encoding.smart_text(body.data[:remains], encoding=self.get_body_charset(obj, body), errors='replace'))
+                data.append(encoding.smart_text(body.data[:remains], encoding=charset, errors='replace'))
                 break
             else:
-                data.append(encoding.smart_text(body.data, encoding=self.get_body_charset(obj, body), errors='replace'))
+                data.append(encoding.smart_text(body.data, encoding=charset, errors='replace'))
 
         return u"\n".join(data)
 
-    def get_meta(self, obj):
-        """Extra meta data to save DB queries later"""
-        from inboxen.models import HeaderData
-
-        try:
-            from_header = HeaderData.objects.filter(
-                header__part__parent__isnull=True,
-                header__name__name="From",
-                header__part__email__id=obj.id,
-            )[0]
-            from_header = encoding.smart_text(from_header.data, errors='replace')
-        except IndexError:
-            from_header = u""
-
-        return {
-            "from": from_header,
-            "inbox": obj.inbox.inbox,
-            "domain": obj.inbox.domain.domain,
-        }
-
 
 class InboxSearchAdapter(search.SearchAdapter):
     def get_title(self, obj):
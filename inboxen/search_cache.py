@@ -0,0 +1,62 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Cache keys for search results
+
+Queries are normalised before they're turned into a key, so searches that
+only differ by case or whitespace share results.
+
+Each user has a search generation that's part of every key. It's
+bumped whenever something that could change their results happens (e.g. an
+email is indexed or deleted), which invalidates all of their cached results
+at once. Results can then be cached for a long time.
+"""
+
+import hashlib
+
+from django.utils.encoding import smart_bytes
+
+from inboxen import cache_generations
+
+
+GENERATION_KEY = "search-generation-{0}"
+
+
+def normalize_query(term):
+    """Lower case `term` and collapse whitespace"""
+    return u" ".join(term.lower().split())
+
+
+def get_generation(user_id):
+    return cache_generations.get_generation(GENERATION_KEY.format(user_id))
+
+
+def bump_generation(user_id):
+    """Invalidate all of a user's cached search results"""
+    cache_generations.bump_generation(GENERATION_KEY.format(user_id))
+
+
+def get_cache_key(user_id, term, after=None, generation=None):
+    """Cache key for a page of search results
+
+    Uses the user's current generation unless `generation` is given
+    """
+    if generation is None:
+        generation = get_generation(user_id)
+    query = smart_bytes(u"{0}\n{1}".format(normalize_query(term), after or u""))
+    return "search-{0}-{1}-{2}".format(user_id, generation, hashlib.sha1(query).hexdigest())
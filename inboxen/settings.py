@@ -37,6 +37,9 @@ djcelery.setup_loader()
 # if you change this, you'll need to do a datamigration to change the rest
 COLUMN_HASHER = "sha1"
 
+# Bodies are hashed and uploaded to the database in chunks of this size
+BODY_CHUNK_SIZE = 2 ** 20
+
 # passed directly to random.choice when creating an Inbox
 INBOX_CHOICES = string.ascii_lowercase
 
@@ -21,10 +21,13 @@ from datetime import datetime
 
 from django.conf import settings
 from django.contrib import messages
-from django.db import models
+from django.db import models, transaction
 
 from pytz import utc
 
+from inboxen import recipient_cache, search_cache
+from inboxen.body_storage import get_file_storage, lock_hash
+
 
 def decided_checker(sender, instance=None, **kwargs):
     if instance.date_decided is None and instance.succeeded is not None and instance.authorizer is not None:
@@ -43,3 +46,44 @@ def decided_checker(sender, instance=None, **kwargs):
 def logout_message(sender, request, **kwargs):
     msg = getattr(request, "_logout_message", settings.LOGOUT_MSG)
     messages.add_message(request, messages.INFO, msg)
+
+
+def delete_body_file(sender, instance=None, **kwargs):
+    """Remove a Body's file from storage once its row is gone"""
+    if instance.flags.on_disk:
+        hashed = instance.hashed
+        transaction.on_commit(lambda: _delete_body_file(sender, hashed))
+
+
+def _delete_body_file(model, hashed):
+    """Delete the file for `hashed`, unless a new Body has been delivered with
+    the same hash since the old one was deleted"""
+    with transaction.atomic():
+        lock_hash(hashed)
+        if not model.objects.filter(hashed=hashed, flags=model.flags.on_disk).exists():
+            get_file_storage().delete(hashed)
+
+
+def inbox_saved(sender, instance=None, **kwargs):
+    """Tell the router's recipient cache if an inbox can receive email"""
+    receiving = instance.user_id is not None and instance.domain.enabled and \
+        not (instance.flags.deleted or instance.flags.disabled)
+    inbox, domain = instance.inbox, instance.domain.domain
+    transaction.on_commit(lambda: recipient_cache.set_receiving(inbox, domain, receiving))
+
+
+def inbox_deleted(sender, instance=None, **kwargs):
+    inbox, domain = instance.inbox, instance.domain.domain
+    transaction.on_commit(lambda: recipient_cache.set_receiving(inbox, domain, False))
+
+
+def clear_recipient_cache(sender, **kwargs):
+    """Something has changed that could affect many inboxes"""
+    transaction.on_commit(recipient_cache.bump_generation)
+
+
+def clear_search_cache(sender, instance=None, **kwargs):
+    """An inbox has changed, so a user's search results may have too"""
+    user_id = instance.user_id
+    if user_id is not None:
+        transaction.on_commit(lambda: search_cache.bump_generation(user_id))
@@ -5,9 +5,11 @@
 
 (function($) {
     'use strict';
-    var timer;
+    // polls are cheap, so start quickly and back off
+    var delay = 500;
+    var maxDelay = 7000;
 
-    function AreWeReadyYet($refreshNote, $searchInfo, timer) {
+    function AreWeReadyYet($refreshNote, $searchInfo) {
         var http = new XMLHttpRequest();
         http.open("HEAD", $refreshNote.data("url"), true);
         http.onload = function (e) {
@@ -15,18 +17,16 @@
                 if (http.status == 202) {
                     // not done
                     $refreshNote.html("");
+                    schedulePoll($refreshNote, $searchInfo);
                 } else if (http.status == 201) {
                     // done!
-                    clearInterval(timer);
                     $refreshNote.html("Loading results…");
-                    location.reload(true);
+                    window.location = $refreshNote.data("results-url");
                 } else if (http.status == 400) {
-                    clearInterval(timer);
                     $searchInfo.html("The search timed out. Please try again.");
                     $searchInfo.addClass("alert alert-warning");
                     console.error("Server says there is no such search");
                 } else {
-                    clearInterval(timer);
                     $searchInfo.html("Something went wrong while searching. Please try again later.");
                     $searchInfo.addClass("alert alert-warning");
                     console.error("Unexpected response code");
@@ -35,6 +35,12 @@
         };
         http.send(null);
     }
+
+    function schedulePoll($refreshNote, $searchInfo) {
+        setTimeout(function(){AreWeReadyYet($refreshNote, $searchInfo);}, delay);
+        delay = Math.min(delay * 2, maxDelay);
+    }
+
     var $refreshNote = $("#search-refreshnote");
     var $searchInfo = $("#search-info");
 
@@ -47,6 +53,5 @@
         return;
     }
     $refreshNote.html("");
-    // poll the server every 7000 ms
-    timer = setInterval(function(){AreWeReadyYet($refreshNote, $searchInfo, timer);}, 7000);
+    schedulePoll($refreshNote, $searchInfo);
 })(jQuery);
@@ -21,7 +21,6 @@ from datetime import datetime, timedelta
 from importlib import import_module
 import gc
 import logging
-import urllib
 
 from django.apps import apps
 from django.conf import settings
@@ -34,12 +33,21 @@ from django.db.models import Avg, Count, F, Max, Min, StdDev, Sum
 from pytz import utc
 from watson import search as watson_search
 
-from inboxen import models
+from inboxen import lookup_cache, models, search_cache
+from inboxen import search as inboxen_search
 from inboxen.celery import app
+from inboxen.utils.email import load_bodies, prerender_html_part
 
 log = logging.getLogger(__name__)
 
-SEARCH_TIMEOUT = 60 * 30
+# search results are invalidated by inboxen.search_cache, so they can be kept
+# for a while
+SEARCH_TIMEOUT = 60 * 60 * 24
+
+# how long to wait for a search task before starting another
+SEARCH_PENDING_TIMEOUT = 60 * 5
+
+LOOKUP_CACHED_MODELS = (models.Body, models.HeaderData, models.HeaderName)
 
 
 @app.task(ignore_result=True)
@@ -188,24 +196,58 @@ def requests():
 
 
 @app.task(rate_limit="100/s")
-def search(user_id, search_term):
-    """Offload the expensive part of search to avoid blocking the web interface"""
-    email_subquery = models.Email.objects.viewable(user_id)
-    inbox_subquery = models.Inbox.objects.viewable(user_id)
+def search(user_id, search_term, after=None, cache_key=None):
+    """Offload the expensive part of search to avoid blocking the web interface
 
+    Only one page of emails is found, `after` is the cursor of the page to
+    start from. Inboxes are only searched for on the first page.
+
+    Results are cached under `cache_key`, which should be worked out before
+    the task is queued. Otherwise new mail arriving while we search could put
+    these results under the next generation's key.
+    """
+    emails, cursor = inboxen_search.search_emails(user_id, search_term, after=after)
     results = {
-        "emails": list(watson_search.search(search_term, models=(email_subquery,)).values_list("id", flat=True)),
-        "inboxes": list(watson_search.search(search_term, models=(inbox_subquery,)).values_list("id", flat=True)),
+        "emails": emails,
+        "inboxes": [],
+        "after": cursor,
     }
 
-    key = u"{0}-{1}".format(user_id, search_term)
-    key = urllib.quote(key.encode("utf-8"))
+    if after is None:
+        inbox_subquery = models.Inbox.objects.viewable(user_id)
+        inboxes = watson_search.search(search_term, models=(inbox_subquery,)).values_list("id", flat=True)
+        results["inboxes"] = list(inboxes[:inboxen_search.SEARCH_PAGE_SIZE])
 
-    cache.set(key, results, SEARCH_TIMEOUT)
+    if cache_key is None:
+        cache_key = search_cache.get_cache_key(user_id, search_term, after)
+    cache.set(cache_key, results, SEARCH_TIMEOUT)
 
     return results
 
 
+@app.task(ignore_result=True)
+@transaction.atomic()
+def index_emails(email_ids):
+    """Build search index rows for emails, delivery leaves this to us"""
+    emails = models.Email.objects.filter(id__in=email_ids).select_related("inbox")
+    inboxen_search.index_emails(emails)
+
+
+@app.task(ignore_result=True)
+def prerender_html(email_id):
+    """Clean up HTML bodies of an email, so EmailView doesn't have to"""
+    try:
+        email = models.Email.objects.get(id=email_id)
+    except models.Email.DoesNotExist:
+        return
+
+    parts = email.get_parts()
+    load_bodies(parts)
+    for part in parts:
+        if part.is_leaf_node() and part.content_type == "text/html":
+            prerender_html_part(part)
+
+
 @app.task(ignore_result=True)
 def force_garbage_collection():
     """Call the garbage collector.
@@ -225,7 +267,11 @@ def delete_inboxen_item(model, item_pk):
         item = _model.objects.only('pk').get(pk=item_pk)
         item.delete()
     except (IntegrityError, _model.DoesNotExist):
-        pass
+        return
+
+    if _model in LOOKUP_CACHED_MODELS:
+        # router processes may have this row's pk cached
+        transaction.on_commit(lookup_cache.bump_generation)
 
 
 @app.task(rate_limit="1/m")
@@ -0,0 +1,117 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Time how long it takes to clean up the HTML bodies found in
+inboxen/tests/example_emails.py
+
+"sanitise" is parsing, the lxml Cleaner and the image/link rewriting, "old"
+is the same work done the way it was before inboxen.clean: a new Cleaner per
+call and separate //img and //a scans. "full" also includes premailer and
+serialisation.
+
+Run it with:
+
+    DJANGO_SETTINGS_MODULE=inboxen.tests.settings python -m inboxen.tests.bench_html
+"""
+
+from email import message_from_string
+from timeit import default_timer
+import argparse
+import sys
+
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+from lxml import html as lxml_html
+from lxml.html.clean import Cleaner
+
+from inboxen import clean
+from inboxen.tests import example_emails
+from inboxen.utils.email import _clean_html
+from redirect import proxy_url
+
+
+def get_bodies():
+    """Yield (name, body, charset) of each HTML body"""
+    for name in ["BODY", "METALESS_BODY", "CHARSETLESS_BODY", "BODILESS_BODY"]:
+        yield name, getattr(example_emails, name), "utf-8"
+
+    for name in ["EXAMPLE_PREMAILER_BROKEN_CSS", "EXAMPLE_ALT"]:
+        msg = message_from_string(getattr(example_emails, name))
+        for i, part in enumerate(msg.walk()):
+            if part.get_content_type() == "text/html":
+                yield "{0}[{1}]".format(name, i), part.get_payload(decode=True), part.get_content_charset("utf-8")
+
+
+def sanitise(body):
+    html_tree = lxml_html.fromstring(body)
+    html_tree = clean.email_cleaner.clean_html(html_tree)
+    clean.rewrite_email_tree(html_tree, False)
+
+
+def old_sanitise(body):
+    html_tree = lxml_html.fromstring(body)
+    cleaner = Cleaner(
+        allow_tags=clean.HTML_ALLOW_TAGS,
+        kill_tags=["style"],
+        remove_unknown_tags=False,
+        safe_attrs=clean.HTML_SAFE_ATTRS,
+        safe_attrs_only=True,
+        style=False,
+    )
+    html_tree = cleaner.clean_html(html_tree)
+
+    for img in html_tree.xpath("//img"):
+        try:
+            del img.attrib["src"]
+            img.attrib["src"] = staticfiles_storage.url("imgs/placeholder.svg")
+        except KeyError:
+            pass
+
+    for link in html_tree.xpath("//a"):
+        try:
+            link.attrib["href"] = proxy_url(link.attrib["href"])
+        except KeyError:
+            pass
+        link.attrib["target"] = "_blank"
+        link.attrib["rel"] = "noreferrer"
+
+
+def time_it(iterations, func, *args):
+    """Mean time of `func` in milliseconds"""
+    start = default_timer()
+    for i in xrange(iterations):
+        func(*args)
+
+    return (default_timer() - start) * 1000 / iterations
+
+
+def run(iterations, stdout):
+    for name, body, charset in get_bodies():
+        new = time_it(iterations, sanitise, body)
+        old = time_it(iterations, old_sanitise, body)
+        full = time_it(iterations, _clean_html, None, body, charset, False)
+        stdout.write("{0}: sanitise {1:.3f}ms (old {2:.3f}ms), full {3:.3f}ms\n".format(name, new, old, full))
+
+
+if __name__ == "__main__":
+    import django
+    django.setup()
+
+    parser = argparse.ArgumentParser(description="Benchmark HTML email sanitising")
+    parser.add_argument("--iterations", type=int, default=100, help="times to clean each body")
+    run(parser.parse_args().iterations, sys.stdout)
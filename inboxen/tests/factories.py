@@ -24,9 +24,8 @@ from django.contrib.auth import get_user_model
 from pytz import utc
 import factory
 import factory.fuzzy
-from watson import search
 
-from inboxen import models
+from inboxen import models, search
 
 
 class FuzzyBinary(factory.fuzzy.FuzzyText):
@@ -103,16 +102,19 @@ class HeaderFactory(factory.django.DjangoModelFactory):
 
 class FullEmailFactory(EmailFactory):
     """Create a full fleshed out Email object, with a plain text body and some
-    headers. It should also produce a search entry
+    headers. It's also added to the search index, unless index=False is passed
     """
     @classmethod
     def _create(cls, model_class, *args, **kwargs):
-        with search.update_index():
-            email = super(FullEmailFactory, cls)._create(model_class, *args, **kwargs)
-            body = BodyFactory(data="This mail body is searchable")
-            part = PartListFactory(email=email, body=body)
-            HeaderFactory(part=part, name="From")
-            HeaderFactory(part=part, name="Subject")
-            HeaderFactory(part=part, name="Content-Type", data="text/plain; charset=\"ascii\"")
+        index = kwargs.pop("index", True)
+        email = super(FullEmailFactory, cls)._create(model_class, *args, **kwargs)
+        body = BodyFactory(data="This mail body is searchable")
+        part = PartListFactory(email=email, body=body)
+        HeaderFactory(part=part, name="From")
+        HeaderFactory(part=part, name="Subject")
+        HeaderFactory(part=part, name="Content-Type", data="text/plain; charset=\"ascii\"")
+
+        if index:
+            search.index_emails([email])
 
         return email
@@ -18,14 +18,19 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import shutil
+import tempfile
+
 from django import test
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core import urlresolvers
+from django.core.cache import cache
+from lxml import html as lxml_html
 from salmon import mail
 
 import mock
 
-from inboxen import models
+from inboxen import clean, models, tasks
 from inboxen.tests import factories, utils
 from inboxen.tests.example_emails import (
     BODILESS_BODY,
@@ -37,7 +42,7 @@ from inboxen.tests.example_emails import (
     EXAMPLE_SIGNED_FORWARDED_DIGEST,
     METALESS_BODY,
 )
-from inboxen.utils import email as email_utils
+from inboxen.utils import email as email_utils, override_settings
 from router.app.helpers import make_email
 
 
@@ -193,12 +198,100 @@ class EmailViewTestCase(test.TestCase):
         email = models.Email.objects.get(pk=self.email.pk)
         self.assertNotEqual(email.flags.important, important)
 
+    def test_etag(self):
+        response = self.client.get(self.get_url())
+        etag = response["ETag"]
+        self.assertIn("Last-Modified", response)
+        self.assertIn("private", response["Cache-Control"])
+        self.assertIn("no-cache", response["Cache-Control"])
+
+        with mock.patch("inboxen.views.inbox.email.find_bodies", side_effect=self.failureException("Rendered email")):
+            response = self.client.get(self.get_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        # flags change how the email is displayed
+        self.client.post(self.get_url(), {"important-toggle": ""})
+        response = self.client.get(self.get_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
+
+        # new session, new CSRF token
+        self.client.logout()
+        self.client.login(username=self.user.username, password="123456", request=utils.MockRequest(self.user))
+        response = self.client.get(self.get_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
+
+        # so does the user's profile
+        self.user.inboxenprofile.flags.prefer_html_email = not self.user.inboxenprofile.flags.prefer_html_email
+        self.user.inboxenprofile.save()
+        response = self.client.get(self.get_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_etag_csp(self):
+        # browsers replace the cached response's headers with the 304's
+        self.user.inboxenprofile.flags.ask_images = True
+        self.user.inboxenprofile.save()
+
+        for params in [{}, {"imgDisplay": "1"}]:
+            response = self.client.get(self.get_url(), params)
+            self.assertEqual(response.status_code, 200)
+
+            not_modified = self.client.get(self.get_url(), params, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified["Content-Security-Policy"], response["Content-Security-Policy"])
+
+        self.assertIn("img-src 'self' https:", response["Content-Security-Policy"])
+
+    @override_settings(HTML_CSS_MAX_SIZE=10)
+    def test_no_css_too_big(self):
+        cache.clear()
+        response = self.client.get(self.get_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(u"<p style=\"color:#fff\">", response.context["email"]["bodies"][0])
+        self.assertIn(u"<p>&#163;&#163;&#163;</p>", response.context["email"]["bodies"][0])
+        self.assertNotIn("Part of this message could not be parsed - it may not display correctly", response.content)
+
+    @override_settings(HTML_CSS_MAX_NODES=5)
+    def test_no_css_too_many_nodes(self):
+        cache.clear()
+        response = self.client.get(self.get_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(u"<p style=\"color:#fff\">", response.context["email"]["bodies"][0])
+
+    @override_settings(HTML_MAX_SIZE=400)
+    def test_truncated(self):
+        cache.clear()
+        response = self.client.get(self.get_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["email"]["truncated"])
+        self.assertIn("?fullHtml=1", response.content)
+        self.assertNotIn("ETag", response)
+        self.assertNotIn("Click me!", response.context["email"]["bodies"][0])
+
+        with mock.patch("inboxen.views.inbox.email.tasks.prerender_html.delay") as delay_mock:
+            self.client.get(self.get_url() + "?fullHtml=1")
+            response = self.client.get(self.get_url() + "?fullHtml=1")
+        delay_mock.assert_called_once_with(self.email.id)
+        self.assertTrue(response.context["email"]["full_pending"])
+        self.assertIn("The full message is being prepared", response.content)
+
+        tasks.prerender_html(self.email.id)
+        response = self.client.get(self.get_url())
+        self.assertFalse(response.context["email"]["truncated"])
+        self.assertIn("Click me!", response.context["email"]["bodies"][0])
+
     def test_html_a(self):
         response = self.client.get(self.get_url())
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context["email"]["bodies"]), 1)
         body = response.context["email"]["bodies"][0]
-        self.assertIn(u'<a href="/click/?url=http%3A//example.com/%3Fq%3Dthing" target="_blank" rel="noreferrer">link</a>', body)
+        self.assertIn(u'<a href="/click/?url=http%3A//example.com/%3Fq%3Dthing" target="_blank" rel="noreferrer">'
+                      u'link</a>', body)
 
     def test_not_allowed_tag(self):
         response = self.client.get(self.get_url())
@@ -307,7 +400,8 @@ class BadEmailTestCase(test.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context["email"]["bodies"]), 1)
         body = response.context["email"]["bodies"][0]
-        self.assertIn(u'<a href="/click/?url=http%3A//example.com/%3Fq%3Dthing" target="_blank" rel="noreferrer">link</a>', body)
+        self.assertIn(u'<a href="/click/?url=http%3A//example.com/%3Fq%3Dthing" target="_blank" rel="noreferrer">'
+                      u'link</a>', body)
 
 
 class RealExamplesTestCase(test.TestCase):
@@ -340,6 +434,38 @@ class RealExamplesTestCase(test.TestCase):
         leaf_part_count = len([i for i in self.email.get_parts() if i.is_leaf_node()])
         self.assertEqual(len(response.context["email"]["bodies"]), leaf_part_count)
 
+    def test_get_parts_queries(self):
+        make_email(mail.MailRequest("", "", "", EXAMPLE_DIGEST), self.inbox)
+        make_email(mail.MailRequest("", "", "", EXAMPLE_ALT), self.inbox)
+        digest, alternative = models.Email.objects.order_by("id")
+
+        # same number of queries, however many parts there are
+        for email in [digest, alternative]:
+            with self.assertNumQueries(3):
+                parts = email.get_parts()
+                email_utils.load_bodies(parts)
+                for part in parts:
+                    if part.is_leaf_node():
+                        part.body.data
+                    part.content_type
+
+    def test_load_bodies(self):
+        make_email(mail.MailRequest("", "", "", EXAMPLE_SIGNED_FORWARDED_DIGEST), self.inbox)
+        email = models.Email.objects.get()
+
+        parts = email.get_parts()
+        email_utils.load_bodies(parts)
+        signatures = [part for part in parts if part.content_type == "application/pgp-signature"]
+        self.assertEqual(len(signatures), 2)
+        for part in parts:
+            if part in signatures:
+                # attachments aren't loaded
+                self.assertIn("_data", part.body.get_deferred_fields())
+                self.assertEqual(part.filename, "signature.asc")
+                self.assertEqual(part.size, part.body.size)
+            elif part.content_type == "text/plain":
+                self.assertEqual(part.body.get_deferred_fields(), set())
+
     def test_signed_forwarded_digest(self):
         self.msg = mail.MailRequest("", "", "", EXAMPLE_SIGNED_FORWARDED_DIGEST)
         make_email(self.msg, self.inbox)
@@ -382,7 +508,8 @@ class AttachmentTestCase(test.TestCase):
         self.email = factories.EmailFactory(inbox__user=self.user)
         body = factories.BodyFactory(data=BODY)
         self.part = factories.PartListFactory(email=self.email, body=body)
-        self.content_type_header, _ = factories.HeaderFactory(part=self.part, name="Content-Type", data="text/html; charset=\"utf-8\"")
+        self.content_type_header, _ = factories.HeaderFactory(part=self.part, name="Content-Type",
+                                                              data="text/html; charset=\"utf-8\"")
 
         login = self.client.login(username=self.user.username, password="123456", request=utils.MockRequest(self.user))
 
@@ -412,6 +539,76 @@ class AttachmentTestCase(test.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Disposition"], "attachment; filename=\"Växjö.jpg\"")
 
+    def test_range(self):
+        url = urlresolvers.reverse("email-attachment", kwargs={"attachmentid": self.part.id})
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        self.assertEqual("".join(response.streaming_content), BODY)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response["Content-Length"], str(len(BODY)))
+
+        response = self.client.get(url, HTTP_RANGE="bytes=6-11")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual("".join(response.streaming_content), BODY[6:12])
+        self.assertEqual(response["Content-Range"], "bytes 6-11/{0}".format(len(BODY)))
+        self.assertEqual(response["Content-Length"], "6")
+
+        response = self.client.get(url, HTTP_RANGE="bytes=-8")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual("".join(response.streaming_content), BODY[-8:])
+
+        response = self.client.get(url, HTTP_RANGE="bytes={0}-".format(len(BODY)))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */{0}".format(len(BODY)))
+
+        # multiple ranges aren't supported, so send everything
+        response = self.client.get(url, HTTP_RANGE="bytes=0-1,4-5")
+        self.assertEqual(response.status_code, 200)
+
+        # body has changed since the client last saw it
+        response = self.client.get(url, HTTP_RANGE="bytes=6-11", HTTP_IF_RANGE='"sha1:something"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual("".join(response.streaming_content), BODY)
+
+    def test_etag(self):
+        url = urlresolvers.reverse("email-attachment", kwargs={"attachmentid": self.part.id})
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertEqual(etag, '"{0}"'.format(self.part.body.hashed))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"sha1:something"')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("private", response["Cache-Control"])
+
+        last_modified = response["Last-Modified"]
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # If-None-Match wins
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified, HTTP_IF_NONE_MATCH='"sha1:something"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_file_storage(self):
+        storage_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_path)
+
+        with override_settings(BODY_STORAGE_BACKEND="inboxen.body_storage.FileStorage",
+                               BODY_STORAGE_PATH=storage_path, BODY_STORAGE_INLINE_THRESHOLD=10):
+            body = factories.BodyFactory(data="This body is on the file system")
+            part = factories.PartListFactory(email=self.email, body=body)
+            self.assertTrue(body.flags.on_disk)
+
+            url = urlresolvers.reverse("email-attachment", kwargs={"attachmentid": part.id})
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            content = "".join(response.streaming_content) if response.streaming else response.content
+            self.assertEqual(content, "This body is on the file system")
+            self.assertEqual(response["Content-Type"], "text/plain")
+
 
 class UtilityTestCase(test.TestCase):
     def test_is_unicode(self):
@@ -436,6 +633,74 @@ class UtilityTestCase(test.TestCase):
         returned_body = email_utils._clean_html_body(None, email, CHARSETLESS_BODY, "ascii")
         self.assertIsInstance(returned_body, unicode)
 
+    def test_rewrite_email_tree(self):
+        html_tree = lxml_html.fromstring(
+            u'<div><img src="a.png"><a href="http://example.com">a</a><img alt="x"><a>b</a></div>'
+        )
+        self.assertTrue(clean.rewrite_email_tree(html_tree, False))
+
+        images = html_tree.findall(".//img")
+        self.assertEqual(images[0].get("src"), staticfiles_storage.url("imgs/placeholder.svg"))
+        self.assertEqual(images[1].get("src"), None)
+
+        links = html_tree.findall(".//a")
+        self.assertEqual(links[0].get("href"), "/click/?url=http%3A//example.com")
+        self.assertEqual(links[1].get("href"), None)
+        for link in links:
+            self.assertEqual(link.get("target"), "_blank")
+            self.assertEqual(link.get("rel"), "noreferrer")
+
+        html_tree = lxml_html.fromstring(u'<div><img src="a.png"></div>')
+        self.assertFalse(clean.rewrite_email_tree(html_tree, True))
+        self.assertEqual(html_tree.find(".//img").get("src"), "a.png")
+
+    def test_render_html_part_cache(self):
+        cache.clear()
+        part = mock.Mock(charset="utf-8")
+        part.body = factories.BodyFactory(data=BODY)
+
+        email = {"display_images": False, "has_images": False}
+        first = email_utils._render_html_part(None, email, part)
+        self.assertTrue(email["has_images"])
+
+        # another user, same body
+        email = {"display_images": False, "has_images": False}
+        with mock.patch("inboxen.utils.email._clean_html", side_effect=self.failureException("Cache missed")):
+            second = email_utils._render_html_part(None, email, part)
+        self.assertEqual(first, second)
+        self.assertTrue(email["has_images"])
+
+        # images change the output, so they're cached separately
+        email = {"display_images": True, "has_images": False}
+        third = email_utils._render_html_part(None, email, part)
+        self.assertNotEqual(first, third)
+        self.assertFalse(email["has_images"])
+
+    def test_render_html_part_prerendered(self):
+        cache.clear()
+        part = mock.Mock(charset="utf-8")
+        part.body = factories.BodyFactory(data=BODY)
+        models.RenderedBody.objects.create(body=part.body, charset="utf-8", display_images=False,
+                                           html=u"<p>prerendered</p>", has_images=True)
+
+        email = {"display_images": False, "has_images": False}
+        with mock.patch("inboxen.utils.email._clean_html", side_effect=self.failureException("Not prerendered")):
+            body = email_utils._render_html_part(None, email, part)
+        self.assertEqual(body, u"<p>prerendered</p>")
+        self.assertTrue(email["has_images"])
+
+    @mock.patch("inboxen.utils.email.RENDERED_BODY_MAX_SIZE", 10)
+    def test_render_html_part_too_big(self):
+        cache.clear()
+        part = mock.Mock(charset="utf-8")
+        part.body = factories.BodyFactory(data=BODY)
+
+        email = {"display_images": True, "has_images": False}
+        with mock.patch("inboxen.utils.email._clean_html", wraps=email_utils._clean_html) as clean_mock:
+            email_utils._render_html_part(None, email, part)
+            email_utils._render_html_part(None, email, part)
+        self.assertEqual(clean_mock.call_count, 2)
+
     def test_invalid_charset(self):
         text = "Växjö"
         self.assertEqual(email_utils._unicode_damnit(text, "utf-8"), u"Växjö")
@@ -21,6 +21,7 @@ import itertools
 
 from django import test
 from django.core import urlresolvers
+import mock
 
 from inboxen import models
 from inboxen.tests import factories
@@ -99,6 +100,17 @@ class InboxTestAbstract(object):
         with self.assertRaises(models.Email.DoesNotExist):
             models.Email.objects.get(id=email.id)
 
+    def test_post_single_delete_search_cache(self):
+        email = self.emails[0]
+        with mock.patch("inboxen.views.inbox.inbox.transaction.on_commit") as commit_mock, \
+                mock.patch("inboxen.views.inbox.inbox.search_cache.bump_generation") as bump_mock:
+            self.client.post(self.get_url(), {"delete-single": email.eid})
+            # search results can't change until the delete is committed
+            self.assertEqual(bump_mock.call_count, 0)
+
+            commit_mock.call_args[0][0]()
+            bump_mock.assert_called_once_with(self.user.id)
+
     def test_post_single_important(self):
         email = self.emails[0]
         response = self.client.post(self.get_url(), {"important-single": email.eid})
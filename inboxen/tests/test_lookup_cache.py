@@ -0,0 +1,100 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django import test
+from django.core.cache import cache
+
+import mock
+
+from inboxen import lookup_cache, models, tasks
+
+
+class LookupCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(LookupCacheTestCase, self).setUp()
+        cache.clear()
+
+    def test_lru(self):
+        lookup = lookup_cache.LookupCache("test", size=2, shared=False)
+        lookup.set_many({"a": 1, "b": 2})
+        self.assertEqual(lookup.get_many(["a"]), {"a": 1})
+
+        # "b" is the least recently used now
+        lookup.set_many({"c": 3})
+        self.assertEqual(lookup.get_many(["a", "b", "c"]), {"a": 1, "c": 3})
+        self.assertEqual(len(lookup), 2)
+        self.assertEqual(lookup.stats(), {"hits": 3, "misses": 1, "size": 2})
+
+    def test_shared(self):
+        lookup = lookup_cache.LookupCache("test", size=2, shared=True)
+        lookup.check_generation()
+        lookup.set_many({"a": 1})
+
+        other_lookup = lookup_cache.LookupCache("test", size=2, shared=True)
+        other_lookup.check_generation()
+        self.assertEqual(other_lookup.get_many(["a", "b"]), {"a": 1})
+        self.assertEqual(other_lookup.hits, 1)
+        self.assertEqual(other_lookup.misses, 1)
+
+    def test_generation(self):
+        lookup = lookup_cache.LookupCache("test", size=2, shared=False)
+        lookup.check_generation()
+        lookup.set_many({"a": 1})
+
+        lookup.check_generation()
+        self.assertEqual(len(lookup), 1)
+
+        lookup_cache.bump_generation()
+        lookup.check_generation()
+        self.assertEqual(len(lookup), 0)
+
+    def test_generation_evicted(self):
+        lookup = lookup_cache.LookupCache("test", size=2, shared=True)
+        lookup.check_generation()
+        lookup.set_many({"a": 1})
+
+        # an evicted generation must not bring back old entries
+        cache.delete(lookup_cache.GENERATION_KEY)
+        other_lookup = lookup_cache.LookupCache("test", size=2, shared=True)
+        other_lookup.check_generation()
+        self.assertEqual(other_lookup.get_many(["a"]), {})
+
+    def test_get_or_create_many(self):
+        lookup = lookup_cache.LookupCache("test", size=10, shared=False)
+        lookup.set_many({"From": 1})
+
+        queryset = mock.Mock()
+        queryset.get_or_create_many.return_value = {"To": 2}
+        with mock.patch("inboxen.lookup_cache.transaction.on_commit", lambda func: func()):
+            self.assertEqual(lookup.get_or_create_many(queryset, {"From", "To"}), {"From": 1, "To": 2})
+        queryset.get_or_create_many.assert_called_once_with({"To"})
+
+        queryset.reset_mock()
+        self.assertEqual(lookup.get_or_create_many(queryset, {"From", "To"}), {"From": 1, "To": 2})
+        self.assertEqual(queryset.get_or_create_many.call_count, 0)
+
+    def test_delete_bumps_generation(self):
+        name = models.HeaderName.objects.create(name="X-Unused")
+        generation = lookup_cache.get_generation()
+
+        with mock.patch("inboxen.tasks.transaction.on_commit", lambda func: func()):
+            tasks.delete_inboxen_item.delay("headername", name.pk)
+
+        self.assertEqual(models.HeaderName.objects.filter(pk=name.pk).count(), 0)
+        self.assertNotEqual(lookup_cache.get_generation(), generation)
@@ -20,7 +20,11 @@
 from email.message import Message
 from StringIO import StringIO
 from subprocess import CalledProcessError
+import json
+import os
+import shutil
 import sys
+import tempfile
 
 from django import test
 from django.conf import settings as dj_settings
@@ -37,13 +41,14 @@ from django.test.client import RequestFactory
 
 import mock
 
+from inboxen import compression, models, search
 from inboxen.management.commands import router, feeder, url_stats
 from inboxen.middleware import (
     ExtendSessionMiddleware,
     RedirectWagLoginMiddleware,
     WagtailAdminProtectionMiddleware,
 )
-from inboxen.tests import factories, utils
+from inboxen.tests import bench_html, factories, utils
 from inboxen.utils import is_reserved, override_settings
 from inboxen.views.error import ErrorView
 
@@ -409,6 +414,130 @@ class RouterCommandTest(test.TestCase):
         output = mgmt_command.salmon_start()
         self.assertEqual(output, ["Starting Salmon handler: boot\n"])
 
+        with override_settings(ROUTER_SPOOL=True):
+            mgmt_command = router.Command()
+
+        output = mgmt_command.salmon_start()
+        self.assertEqual(output, ["Starting Salmon handler: boot\n", "Starting Salmon handler: spool\n"])
+
+    @mock.patch("inboxen.management.commands.router.glob.glob")
+    @mock.patch("inboxen.management.commands.router.check_output")
+    def test_workers(self, check_mock, glob_mock):
+        check_mock.return_value = "test"
+        glob_mock.return_value = ["router/run/router-2.pid", "router/run/router-1.pid"]
+        mgmt_command = router.Command()
+
+        output = mgmt_command.salmon_stop()
+        self.assertEqual(output, ["test", "test", "test"])
+        self.assertEqual([call[0][0][3] for call in check_mock.call_args_list],
+                         ["run/router.pid", "run/router-1.pid", "run/router-2.pid"])
+        glob_mock.assert_called_with("router/run/router-*.pid")
+
+        check_mock.reset_mock()
+        output = mgmt_command.salmon_status()
+        self.assertEqual(output, ["test", "test", "test"])
+        self.assertEqual([call[0][0][1] for call in check_mock.call_args_list], ["status", "status", "status"])
+
+
+class RecompressCommandTest(test.TestCase):
+    def test_command(self):
+        body_data = "Hello " * 200
+        header_data = "Hewwo " * 200
+        body = models.Body.objects.create(data=body_data, hashed="fakehash")
+        part = models.PartList.objects.create(email=factories.EmailFactory(), body=body)
+        header = part.header_set.create(name="X-Hello", data=header_data, ordinal=0)[0]
+
+        self.assertEqual(models.Body.objects.get(id=body.id).codec, compression.NONE)
+        self.assertEqual(models.HeaderData.objects.get(id=header.data_id).codec, compression.NONE)
+
+        with override_settings(COMPRESSION_CODEC="zlib"):
+            call_command("recompress", batch_size=1, stdout=StringIO())
+
+        body = models.Body.objects.get(id=body.id)
+        self.assertEqual(body.codec, compression.ZLIB)
+        self.assertEqual(body.data, body_data)
+
+        data = models.HeaderData.objects.get(id=header.data_id)
+        self.assertEqual(data.codec, compression.ZLIB)
+        self.assertEqual(data.data, header_data)
+
+        # and back again, bigger rows than batch_bytes still get done
+        with override_settings(COMPRESSION_CODEC="none"):
+            call_command("recompress", batch_bytes=10, stdout=StringIO())
+
+        body = models.Body.objects.get(id=body.id)
+        self.assertEqual(body.codec, compression.NONE)
+        self.assertEqual(str(body._data), body_data)
+
+        data = models.HeaderData.objects.get(id=header.data_id)
+        self.assertEqual(data.codec, compression.NONE)
+        self.assertEqual(data.data, header_data)
+
+
+class SearchBacklogCommandTest(test.TestCase):
+    def test_command(self):
+        factories.EmailFactory.create_batch(3, inbox__user=factories.UserFactory())
+
+        stdout = StringIO()
+        call_command("search_backlog", stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "3 emails waiting to be indexed\n")
+
+        with mock.patch("inboxen.tasks.index_emails.delay") as delay_mock:
+            call_command("search_backlog", queue=True, batch_size=2, stdout=StringIO())
+        self.assertEqual(delay_mock.call_count, 2)
+        self.assertEqual(search.unindexed_emails().count(), 3)
+
+        stdout = StringIO()
+        call_command("search_backlog", drain=True, batch_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "3 emails waiting to be indexed\n3 emails indexed\n")
+        self.assertEqual(search.unindexed_emails().count(), 0)
+
+
+class ReindexEmailsCommandTest(test.TestCase):
+    def setUp(self):
+        super(ReindexEmailsCommandTest, self).setUp()
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        self.state = os.path.join(state_dir, "state.json")
+
+    def test_command(self):
+        user = factories.UserFactory()
+        factories.FullEmailFactory.create_batch(2, inbox__user=user)
+        factories.FullEmailFactory.create_batch(3, inbox__user=user, index=False)
+        self.assertEqual(search.unindexed_emails().count(), 3)
+
+        stdout = StringIO()
+        call_command("reindex_emails", workers=1, range_size=2, state=self.state, stdout=stdout)
+
+        self.assertIn("Reindex complete", stdout.getvalue())
+        self.assertEqual(search.unindexed_emails().count(), 0)
+        self.assertEqual(models.EmailSearch.objects.count(), 5)
+        self.assertFalse(os.path.exists(self.state))
+
+    def test_resume(self):
+        emails = factories.FullEmailFactory.create_batch(2, inbox__user=factories.UserFactory(), index=False)
+
+        with open(self.state, "w") as state_file:
+            # pretend the range with the first email has been done
+            json.dump({"max_id": emails[1].id, "range_size": emails[1].id, "done": [0]}, state_file)
+
+        stdout = StringIO()
+        call_command("reindex_emails", workers=1, state=self.state, stdout=stdout)
+
+        self.assertIn("Resuming reindex, 1 ranges already done", stdout.getvalue())
+        self.assertEqual(list(search.unindexed_emails()), [emails[0]])
+
+
+class BenchHtmlTestCase(test.TestCase):
+    def test_run(self):
+        stdout = StringIO()
+        bench_html.run(1, stdout)
+
+        output = stdout.getvalue()
+        self.assertIn("BODILESS_BODY: sanitise ", output)
+        self.assertIn("(old ", output)
+        self.assertIn("EXAMPLE_ALT[", output)
+
 
 class ErrorViewTestCase(test.TestCase):
     def test_view(self):
@@ -19,15 +19,20 @@
 
 import datetime
 import itertools
+import os
+import shutil
+import tempfile
 
 from pytz import utc
+import mock
 
 from django import test
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
-from inboxen import models
+from inboxen import compression, models
 from inboxen.tests import factories
+from inboxen.utils import override_settings
 
 
 User = get_user_model()
@@ -163,6 +168,117 @@ class ModelTestCase(test.TestCase):
         self.assertTrue(body1[1])
         self.assertFalse(body2[1])
 
+    def test_body_file_storage(self):
+        body_data = "Hello, this is a long body"
+        storage_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_path)
+
+        with override_settings(BODY_STORAGE_BACKEND="inboxen.body_storage.FileStorage",
+                               BODY_STORAGE_PATH=storage_path, BODY_STORAGE_INLINE_THRESHOLD=10):
+            small_body = models.Body.objects.get_or_create(data="Hello")[0]
+            self.assertFalse(small_body.flags.on_disk)
+            self.assertEqual(small_body.path, None)
+
+            body = models.Body.objects.get_or_create(data=body_data)[0]
+            body = models.Body.objects.get(id=body.id)
+            self.assertTrue(body.flags.on_disk)
+            self.assertEqual(str(body._data), "")
+            self.assertEqual(body.data, body_data)
+            self.assertEqual(body.size, len(body_data))
+            self.assertTrue(body.path.startswith(storage_path))
+            self.assertEqual(open(body.path).read(), body_data)
+            self.assertEqual(os.stat(body.path).st_mode & 0777, 0640)
+            self.assertEqual(os.stat(os.path.dirname(body.path)).st_mode & 0777, 0750)
+
+        # switching back to the database doesn't lose existing files
+        with override_settings(BODY_STORAGE_PATH=storage_path):
+            body = models.Body.objects.get(id=body.id)
+            self.assertEqual(body.data, body_data)
+            self.assertEqual("".join(body.iter_data()), body_data)
+            self.assertTrue(body.path.startswith(storage_path))
+
+            with mock.patch("inboxen.signals.transaction.on_commit", lambda func: func()):
+                body.delete()
+            self.assertFalse(os.path.exists(body.path))
+
+    def test_body_file_redelivered(self):
+        body_data = "Hello, this is a long body"
+        storage_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_path)
+
+        with override_settings(BODY_STORAGE_BACKEND="inboxen.body_storage.FileStorage",
+                               BODY_STORAGE_PATH=storage_path, BODY_STORAGE_INLINE_THRESHOLD=10):
+            body = models.Body.objects.create(data=body_data)
+
+            with mock.patch("inboxen.signals.transaction.on_commit") as commit_mock:
+                body.delete()
+
+            # the same body is delivered again before the delete is committed
+            new_body = models.Body.objects.create(data=body_data)
+            commit_mock.call_args[0][0]()
+
+            self.assertTrue(os.path.exists(new_body.path))
+            self.assertEqual(models.Body.objects.get(id=new_body.id).data, body_data)
+
+    def test_body_compression(self):
+        body_data = "Hello " * 200
+
+        with override_settings(COMPRESSION_CODEC="zlib", COMPRESSION_MIN_SIZE=100):
+            small_body = models.Body.objects.get_or_create(data="Hello")[0]
+            body = models.Body.objects.get_or_create(data=body_data)[0]
+
+        small_body = models.Body.objects.get(id=small_body.id)
+        self.assertEqual(small_body.codec, compression.NONE)
+        self.assertEqual(small_body.data, "Hello")
+
+        body = models.Body.objects.get(id=body.id)
+        self.assertEqual(body.codec, compression.ZLIB)
+        self.assertTrue(len(body._data) < len(body_data))
+        self.assertEqual(body.data, body_data)
+        self.assertEqual(body.size, len(body_data))
+
+    @override_settings(BODY_CHUNK_SIZE=7)
+    def test_body_iter_data(self):
+        body_data = "".join("Hello {0} ".format(i % 10) for i in range(200))
+        storage_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_path)
+
+        with override_settings(COMPRESSION_CODEC="zlib", COMPRESSION_MIN_SIZE=100):
+            compressed = models.Body.objects.create(data=body_data, hashed="compressed")
+        plain = models.Body.objects.create(data=body_data, hashed="plain")
+        with override_settings(BODY_STORAGE_BACKEND="inboxen.body_storage.FileStorage",
+                               BODY_STORAGE_PATH=storage_path, BODY_STORAGE_INLINE_THRESHOLD=10):
+            on_disk = models.Body.objects.create(data=body_data, hashed="sha1:ondisk")
+
+            for body in [compressed, plain, on_disk]:
+                body = models.Body.objects.defer("_data").get(id=body.id)
+                self.assertEqual("".join(body.iter_data()), body_data)
+                self.assertEqual("".join(body.iter_data(10, 100)), body_data[10:100])
+                self.assertEqual("".join(body.iter_data(len(body_data) - 3)), body_data[-3:])
+
+            for body in [compressed, plain]:
+                self.assertTrue(all(len(chunk) <= 7 for chunk in body.iter_data()))
+
+        self.assertEqual(compressed.codec, compression.ZLIB)
+        self.assertEqual(plain.codec, compression.NONE)
+        self.assertTrue(on_disk.flags.on_disk)
+
+    def test_header_data_compression(self):
+        header_data = u"Hello \u2603 " * 100
+        body = models.Body.objects.create(data="Hello", hashed="fakehash")
+        part = models.PartList.objects.create(email=factories.EmailFactory(), body=body)
+
+        with override_settings(COMPRESSION_CODEC="zlib", COMPRESSION_MIN_SIZE=100):
+            header = part.header_set.create(name="X-Hello", data=header_data, ordinal=0)[0]
+            part.header_set.create(name="X-Short", data="Hewwo", ordinal=1)
+
+        data = models.HeaderData.objects.get(id=header.data_id)
+        self.assertEqual(data.codec, compression.ZLIB)
+        self.assertEqual(data.data, header_data)
+
+        headers = part.header_set.get_many("X-Hello", "X-Short")
+        self.assertEqual(headers, {"X-Hello": header_data, "X-Short": "Hewwo"})
+
     def test_requests_are_requested(self):
         user = factories.UserFactory()
         profile = user.inboxenprofile
@@ -225,6 +341,16 @@ class ModelFlagsTestCase(test.TestCase):
 
         self.assertEqual(flag_order, profile_flags)
 
+    def test_body_flags_order(self):
+        # DON'T CHANGE ORDER OF THIS LIST
+        flag_order = [
+            "on_disk",
+        ]
+
+        body_flags = list(models.Body.flags)
+
+        self.assertEqual(flag_order, body_flags)
+
     def test_liberation_flags_order(self):
         # DON'T CHANGE ORDER OF THIS LIST
         flag_order = [
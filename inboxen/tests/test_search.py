@@ -18,15 +18,22 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from decimal import Decimal
+
 import mock
-import urllib
 
 from django import test
 from django.core import urlresolvers, cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
+from inboxen import models, search, search_cache
 from inboxen.tests import factories, utils
+from inboxen.utils import override_settings
 
 
+# djcelery's test runner makes tasks eager, which makes SearchView ignore the cache
+@override_settings(CELERY_ALWAYS_EAGER=False)
 class SearchViewTestCase(test.TestCase):
     def setUp(self):
         super(SearchViewTestCase, self).setUp()
@@ -35,8 +42,7 @@ class SearchViewTestCase(test.TestCase):
         login = self.client.login(username=self.user.username, password="123456", request=utils.MockRequest(self.user))
 
         self.url = urlresolvers.reverse("user-search", kwargs={"q": "cheddär"})
-        key = "%s-cheddär" % self.user.id
-        self.key = urllib.quote(key)
+        self.key = search_cache.get_cache_key(self.user.id, u"cheddär")
 
         if not login:
             raise Exception("Could not log in")
@@ -56,9 +62,238 @@ class SearchViewTestCase(test.TestCase):
         # TODO test the template directly
         with mock.patch("inboxen.views.user.search.SearchView.get_queryset", return_value={}):
             response = self.client.get(self.url)
-            self.assertIn(u'data-url="%s"' % urlresolvers.reverse("user-searchapi", kwargs={"q": "cheddär"}), response.content.decode("utf-8"))
+            # only polls are pinned to a generation
+            poll_url = urlresolvers.reverse("user-searchapi", kwargs={"q": "cheddär"})
+            generation = search_cache.get_generation(self.user.id)
+            self.assertIn(u'data-url="%s?generation=%s"' % (poll_url, generation), response.content.decode("utf-8"))
+            self.assertIn(u'data-results-url="%s"' % self.url, response.content.decode("utf-8"))
 
     def test_get(self):
         cache.cache.set(self.key, {"emails": [], "inboxes": []})
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
+
+    def test_emails(self):
+        emails = factories.FullEmailFactory.create_batch(2, inbox__user=self.user)
+        subject = models.HeaderData.objects.get(header__part__email=emails[0], header__name__name="Subject")
+        cached = {"emails": [emails[1].id, emails[0].id], "inboxes": []}
+        cache.cache.set(search_cache.get_cache_key(self.user.id, "searchable"), cached)
+
+        response = self.client.get(urlresolvers.reverse("user-search", kwargs={"q": "searchable"}))
+        results = response.context["search_results"]["emails"]
+        self.assertItemsEqual([result.email for result in results], emails)
+        self.assertIn(subject.data, response.content.decode("utf-8"))
+
+    def test_pages(self):
+        cache.cache.set(self.key, {"emails": [], "inboxes": [], "after": "0.5:3"})
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["next_after"], "0.5:3")
+        self.assertIn(u'?after=0.5%3A3"', response.content.decode("utf-8"))
+
+        cache.cache.set(search_cache.get_cache_key(self.user.id, u"cheddär", "0.5:3"), {"emails": [], "inboxes": []})
+        response = self.client.get(self.url, {"after": "0.5:3"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["after"], "0.5:3")
+        self.assertEqual(response.context["next_after"], None)
+
+        response = self.client.get(self.url, {"after": "cheese"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_pending(self):
+        cache.cache.set(self.key, {"task": "1234"})
+        with mock.patch("inboxen.views.user.search.AsyncResult") as result_mock:
+            result_mock.return_value.ready.return_value = False
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["waiting"])
+        result_mock.assert_called_once_with("1234")
+        self.assertEqual(result_mock.return_value.get.call_count, 0)
+
+    def test_new_mail(self):
+        cache.cache.delete(self.key)
+        with mock.patch("inboxen.views.user.search.tasks.search.apply_async") as task_mock:
+            task_mock.return_value.id = "1234"
+            task_mock.return_value.ready.return_value = False
+            response = self.client.get(self.url)
+        self.assertTrue(response.context["waiting"])
+        self.assertEqual(task_mock.call_args[1]["args"][3], self.key)
+
+        # mail arrives, reloading shows it even if the URL has the old generation
+        cache.cache.set(self.key, {"emails": [], "inboxes": []})
+        generation = search_cache.get_generation(self.user.id)
+        search_cache.bump_generation(self.user.id)
+        with mock.patch("inboxen.views.user.search.tasks.search.apply_async") as task_mock:
+            task_mock.return_value.id = "5678"
+            task_mock.return_value.ready.return_value = False
+            response = self.client.get(self.url, {"generation": generation})
+        self.assertTrue(response.context["waiting"])
+        self.assertEqual(task_mock.call_args[1]["args"][3], search_cache.get_cache_key(self.user.id, u"cheddär"))
+        self.assertNotEqual(task_mock.call_args[1]["args"][3], self.key)
+
+
+class SearchApiViewTestCase(test.TestCase):
+    def setUp(self):
+        super(SearchApiViewTestCase, self).setUp()
+        self.user = factories.UserFactory()
+
+        login = self.client.login(username=self.user.username, password="123456", request=utils.MockRequest(self.user))
+
+        self.url = urlresolvers.reverse("user-searchapi", kwargs={"q": "cheddär"})
+        self.key = search_cache.get_cache_key(self.user.id, u"cheddär")
+
+        if not login:
+            raise Exception("Could not log in")
+
+    def test_no_search(self):
+        cache.cache.delete(self.key)
+        response = self.client.head(self.url)
+        self.assertEqual(response.status_code, 400)
+
+    def test_results(self):
+        cache.cache.set(self.key, {"emails": [], "inboxes": [], "after": None})
+        response = self.client.head(self.url)
+        self.assertEqual(response.status_code, 201)
+
+    def test_task(self):
+        cache.cache.set(self.key, {"task": "1234"})
+        with mock.patch("inboxen.views.user.search.AsyncResult") as result_mock:
+            result_mock.return_value.ready.return_value = False
+            response = self.client.head(self.url)
+            self.assertEqual(response.status_code, 202)
+
+            result_mock.return_value.ready.return_value = True
+            response = self.client.head(self.url)
+            self.assertEqual(response.status_code, 201)
+
+        # never wait for the task
+        self.assertEqual(result_mock.return_value.get.call_count, 0)
+
+    def test_new_mail(self):
+        cache.cache.set(self.key, {"task": "1234"})
+        generation = search_cache.get_generation(self.user.id)
+        search_cache.bump_generation(self.user.id)
+
+        with mock.patch("inboxen.views.user.search.AsyncResult") as result_mock:
+            result_mock.return_value.ready.return_value = False
+            response = self.client.head(self.url, {"generation": generation})
+        self.assertEqual(response.status_code, 202)
+
+        # not a generation, use the current one
+        response = self.client.head(self.url, {"generation": "cheese"})
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchEmailsTestCase(test.TestCase):
+    def test_cursor(self):
+        user = factories.UserFactory()
+        emails = factories.FullEmailFactory.create_batch(5, inbox__user=user)
+
+        found = []
+        after = None
+        for i in range(3):
+            page, after = search.search_emails(user.id, "searchable", after=after, limit=2)
+            found.extend(page)
+            self.assertEqual(len(page), 2 if i < 2 else 1)
+
+        self.assertEqual(after, None)
+        self.assertItemsEqual(found, [email.id for email in emails])
+
+    def test_parse_cursor(self):
+        cursor = search.make_cursor(12, Decimal("0.0607927"))
+        self.assertEqual(search.parse_cursor(cursor), (Decimal("0.0607927"), 12))
+
+        for cursor in ["cheese", "cheese:12", "NaN:12", "Infinity:12", "0.5:cheese"]:
+            with self.assertRaises(ValueError):
+                search.parse_cursor(cursor)
+
+
+class SearchCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(SearchCacheTestCase, self).setUp()
+        cache.cache.clear()
+
+    def test_cache_key(self):
+        key = search_cache.get_cache_key(1, u"cheddär")
+        self.assertEqual(search_cache.get_cache_key(1, u"  Cheddär "), key)
+        self.assertNotEqual(search_cache.get_cache_key(2, u"cheddär"), key)
+        self.assertNotEqual(search_cache.get_cache_key(1, u"cheddär", "0.5:3"), key)
+        self.assertEqual(search_cache.get_cache_key(1, u"cheddar  wensleydale"),
+                         search_cache.get_cache_key(1, u"cheddar wensleydale"))
+
+    def test_generation(self):
+        user = factories.UserFactory()
+        other_user = factories.UserFactory()
+        key = search_cache.get_cache_key(user.id, u"cheddär")
+        other_key = search_cache.get_cache_key(other_user.id, u"cheddär")
+
+        with mock.patch("inboxen.search.transaction.on_commit", lambda func: func()):
+            factories.FullEmailFactory(inbox__user=user)
+        self.assertNotEqual(search_cache.get_cache_key(user.id, u"cheddär"), key)
+        self.assertEqual(search_cache.get_cache_key(other_user.id, u"cheddär"), other_key)
+
+        key = search_cache.get_cache_key(user.id, u"cheddär")
+        with mock.patch("inboxen.signals.transaction.on_commit", lambda func: func()):
+            factories.InboxFactory(user=user)
+        self.assertNotEqual(search_cache.get_cache_key(user.id, u"cheddär"), key)
+
+
+class EmailSearchAdapterTestCase(test.TestCase):
+    def test_index_emails(self):
+        user = factories.UserFactory()
+        emails = factories.FullEmailFactory.create_batch(5, inbox__user=user, index=False)
+        emails = list(models.Email.objects.filter(id__in=[email.id for email in emails]).select_related("inbox"))
+        self.assertEqual(search.unindexed_emails().count(), 5)
+
+        with CaptureQueriesContext(connection) as one_email:
+            search.index_emails(emails[:1])
+
+        with CaptureQueriesContext(connection) as many_emails:
+            search.index_emails(emails[1:])
+
+        self.assertEqual(len(one_email), len(many_emails))
+        self.assertEqual(search.unindexed_emails().count(), 0)
+
+        row = models.EmailSearch.objects.get(email=emails[0])
+        subject = models.HeaderData.objects.get(header__part__email=emails[0], header__name__name="Subject")
+        sender = models.HeaderData.objects.get(header__part__email=emails[0], header__name__name="From")
+        self.assertEqual(row.subject, subject.data)
+        self.assertEqual(row.sender, sender.data)
+        self.assertEqual(row.user_id, user.id)
+        self.assertEqual(row.inbox_id, emails[0].inbox_id)
+
+        # existing rows are replaced
+        search.index_emails(emails[:1])
+        self.assertEqual(models.EmailSearch.objects.count(), 5)
+
+        self.assertItemsEqual(search.search_emails(user.id, "searchable")[0], [email.id for email in emails])
+        self.assertEqual(search.search_emails(user.id, "cheddar"), ([], None))
+        self.assertEqual(search.search_emails(factories.UserFactory().id, "searchable"), ([], None))
+
+        # emails without a user aren't indexed
+        orphan = factories.FullEmailFactory()
+        self.assertFalse(models.EmailSearch.objects.filter(email=orphan).exists())
+
+    def test_index_emails_bad_email(self):
+        user = factories.UserFactory()
+        emails = factories.FullEmailFactory.create_batch(3, inbox__user=user, index=False)
+        emails = list(models.Email.objects.filter(id__in=[email.id for email in emails]).select_related("inbox"))
+
+        # too many lexemes for a tsvector
+        huge = u" ".join(u"w{0:07x}".format(i) for i in xrange(150000))
+
+        def get_content(email):
+            return huge if email.id == emails[1].id else u"searchable\x00 cheddar"
+
+        with mock.patch.object(search.EmailSearchAdapter, "get_content", side_effect=get_content):
+            search.index_emails(emails)
+
+        indexed = models.EmailSearch.objects.values_list("email_id", flat=True)
+        self.assertItemsEqual(indexed, [emails[0].id, emails[2].id])
+        self.assertItemsEqual(search.search_emails(user.id, "cheddar")[0], [emails[0].id, emails[2].id])
+
+    def test_charset(self):
+        adapter = search.EmailSearchAdapter(models.Email)
+        self.assertEqual(adapter.get_charset("text/plain; charset=\"iso-8859-1\""), "iso-8859-1")
+        self.assertEqual(adapter.get_charset("text/plain"), "utf-8")
+        self.assertEqual(adapter.get_charset(None), "utf-8")
@@ -21,13 +21,15 @@ from datetime import datetime, timedelta
 
 from django import test
 from django.core import mail
+from django.core.cache import cache
 from django.contrib.sessions.models import Session
 
 from pytz import utc
 import mock
 
-from inboxen import models, tasks
+from inboxen import models, search, tasks
 from inboxen.tests import factories
+from inboxen.tests.example_emails import BODY
 from inboxen.utils import override_settings
 
 
@@ -79,7 +81,72 @@ class SearchTestCase(test.TestCase):
     def test_search(self):
         user = factories.UserFactory()
         result = tasks.search.delay(user.id, "bizz").get()
-        self.assertItemsEqual(result.keys(), ["emails", "inboxes"])
+        self.assertItemsEqual(result.keys(), ["emails", "inboxes", "after"])
+
+    def test_search_cache_key(self):
+        user = factories.UserFactory()
+        tasks.search.delay(user.id, "bizz", None, "my-key").get()
+        self.assertEqual(cache.get("my-key")["after"], None)
+
+    def test_search_emails(self):
+        user = factories.UserFactory()
+        email = factories.FullEmailFactory(inbox__user=user)
+        factories.FullEmailFactory(inbox__user=factories.UserFactory())
+
+        result = tasks.search.delay(user.id, "searchable").get()
+        self.assertEqual(result["emails"], [email.id])
+
+        email.flags.deleted = True
+        email.save()
+        result = tasks.search.delay(user.id, "searchable").get()
+        self.assertEqual(result["emails"], [])
+
+    def test_index_emails(self):
+        email = factories.EmailFactory(inbox__user=factories.UserFactory())
+        self.assertEqual(list(search.unindexed_emails()), [email])
+
+        tasks.index_emails.delay([email.id])
+        self.assertEqual(list(search.unindexed_emails()), [])
+
+
+class PrerenderHtmlTestCase(test.TestCase):
+    def test_prerender(self):
+        email = factories.EmailFactory()
+        body = factories.BodyFactory(data=BODY)
+        part = factories.PartListFactory(email=email, body=body)
+        factories.HeaderFactory(part=part, name="Content-Type", data="text/html; charset=\"utf-8\"")
+
+        tasks.prerender_html.delay(email.id)
+        rendered = models.RenderedBody.objects.filter(body=body, charset="utf-8")
+        self.assertEqual(rendered.count(), 2)
+        self.assertTrue(rendered.get(display_images=False).has_images)
+        self.assertFalse(rendered.get(display_images=True).has_images)
+        self.assertIn("/click/?url=http%3A//example.com/%3Fq%3Dthing", rendered.get(display_images=True).html)
+
+        # already done
+        tasks.prerender_html.delay(email.id)
+        self.assertEqual(rendered.count(), 2)
+
+    @override_settings(HTML_CSS_MAX_SIZE=10)
+    def test_prerender_no_css_too_big(self):
+        email = factories.EmailFactory()
+        body = factories.BodyFactory(data=BODY)
+        part = factories.PartListFactory(email=email, body=body)
+        factories.HeaderFactory(part=part, name="Content-Type", data="text/html; charset=\"utf-8\"")
+
+        tasks.prerender_html.delay(email.id)
+        html = models.RenderedBody.objects.get(body=body, charset="utf-8", display_images=True).html
+        self.assertNotIn(u"<p style=\"color:#fff\">", html)
+        self.assertIn(u"<p>&#163;&#163;&#163;</p>", html)
+
+    def test_plain_text(self):
+        email = factories.FullEmailFactory()
+        tasks.prerender_html.delay(email.id)
+        self.assertEqual(models.RenderedBody.objects.count(), 0)
+
+    def test_missing_email(self):
+        tasks.prerender_html.delay(0)
+        self.assertEqual(models.RenderedBody.objects.count(), 0)
 
 
 @override_settings(
@@ -21,39 +21,36 @@ models.py) for emails
 
 It's in "utils" because "domain.py" would get confusing :P """
 
-import re
+import hashlib
 import logging
 
+from django.conf import settings
 from django.contrib import messages
-from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
 from django.utils import html as html_utils, safestring
+from django.utils.encoding import smart_bytes
 from django.utils.translation import ugettext as _
 
 from lxml import etree, html as lxml_html
-from lxml.html.clean import Cleaner
-from premailer.premailer import Premailer
 
-from redirect import proxy_url
+from inboxen.models import Body, RenderedBody
+from inboxen import clean
 
 
-HEADER_PARAMS = re.compile(r'([a-zA-Z0-9]+)=["\']?([^"\';=]+)["\']?[;]?')
+# parts with these content types might be displayed by find_bodies, "" is a
+# non-MIME email
+INLINE_CONTENT_TYPES = ["text/html", "text/plain", ""]
 
-HTML_SAFE_ATTRS = ["style", "title", "href", "src", "height", "width"]
-
-HTML_ALLOW_TAGS = ["p", "a", "i", "b", "em", "strong", "ol", "ul", "li", "pre",
-    "code", "img", "div", "span", "table", "tr", "th", "td", "thead", "tbody",
-    "tfooter", "br"]
+# cached HTML is kept under this cache version
+RENDERED_BODY_CACHE_VERSION = "rendered-body"
 
+# don't cache HTML larger than this (in characters)
+RENDERED_BODY_MAX_SIZE = 2 ** 19
 
 _log = logging.getLogger(__name__)
 
 
-class InboxenPremailer(Premailer):
-    def _load_external(self, url):
-        """Don't load external resources"""
-        return ""
-
-
 def _unicode_damnit(data, charset="utf-8", errors="replace"):
     """Makes doubley sure that we can turn the database's binary typees into
     unicode objects
@@ -67,80 +64,148 @@ def _unicode_damnit(data, charset="utf-8", errors="replace"):
         return unicode(str(data), "ascii", errors)
 
 
-def _clean_html_body(request, email, body, charset):
+def _clean_html(request, body, charset, display_images, inline_css=True):
     """Clean up a html part as best we can
 
+    Returns a tuple of (html, whether images were removed, whether CSS failed
+    to render). Nothing here depends on who's looking at the email, so the
+    result can be cached.
+
+    CSS isn't inlined if `inline_css` is False or the document has more than
+    HTML_CSS_MAX_NODES elements.
+
     Doesn't catch LXML errors
     """
     html_tree = lxml_html.fromstring(body)
+    charset = clean.find_charset(html_tree, charset)
+    css_failed = False
 
-    # if the HTML doc says its a different encoding, use that
-    for meta_tag in html_tree.xpath("/html/head/meta"):
-        if meta_tag.get("http-equiv", None) == "Content-Type":
-            content = meta_tag.get("content")
-            try:
-                content = content.split(";", 1)[1]
-                charset = dict(HEADER_PARAMS.findall(content))["charset"]
-                break
-            except (KeyError, IndexError):
-                pass
-        elif meta_tag.get("charset", None):
-            charset = meta_tag.get("charset")
-            break
+    if inline_css:
+        inline_css = clean.count_elements(html_tree, settings.HTML_CSS_MAX_NODES + 1) <= settings.HTML_CSS_MAX_NODES
 
     try:
         # check there's a body and header for premailer
-        if html_tree.find("body"):
-            html_tree = InboxenPremailer(html_tree).transform()
+        if inline_css and html_tree.find("body"):
+            html_tree = clean.InboxenPremailer(html_tree).transform()
     except Exception as exc:
         # Yeah, a pretty wide catch, but Premailer likes to throw up everything and anything
-        messages.info(request, _("Part of this message could not be parsed - it may not display correctly"))
+        css_failed = True
         msg = "Failed to render CSS: %s" % exc
         _log.exception(msg, extra={"request": request})
 
-    # Mail Pile uses this, give back if you come up with something better
-    cleaner = Cleaner(
-        allow_tags=HTML_ALLOW_TAGS,
-        kill_tags = ["style"],  # remove style tags, not attrs
-        remove_unknown_tags=False,
-        safe_attrs=HTML_SAFE_ATTRS,
-        safe_attrs_only=True,
-        style=False,  # keep style attrs
-    )
-
-    html_tree = cleaner.clean_html(html_tree)
-
-    # filter images if we need to
-    if not email["display_images"]:
-        for img in html_tree.xpath("//img"):
-            try:
-                # try to delete src first - we don't want to add a src where there wasn't one already
-                del img.attrib["src"]
-                # replace image with 1px png
-                img.attrib["src"] = staticfiles_storage.url("imgs/placeholder.svg")
-                email["has_images"] = True
-            except KeyError:
-                pass
-
-    for link in html_tree.xpath("//a"):
-        try:
-            # proxy link
-            url = link.attrib["href"]
-            link.attrib["href"] = proxy_url(url)
-        except KeyError:
-            pass
-
-        # open link in tab
-        link.attrib["target"] = "_blank"
-        # and prevent window.opener bug (noopener is only supported in newer
-        # browsers, plus we already set noreferrer in the head)
-        link.attrib["rel"] = "noreferrer"
+    html_tree = clean.email_cleaner.clean_html(html_tree)
+    has_images = clean.rewrite_email_tree(html_tree, display_images)
 
     # finally, export to unicode
     body = _unicode_damnit(etree.tostring(html_tree), charset)
+    return body, has_images, css_failed
+
+
+def _use_clean_html(request, email, cleaned):
+    """Apply the output of `_clean_html` to `email` and return the body"""
+    body, has_images, css_failed = cleaned
+    if has_images:
+        email["has_images"] = True
+    if css_failed:
+        messages.info(request, _("Part of this message could not be parsed - it may not display correctly"))
+
     return safestring.mark_safe(body)
 
 
+def _clean_html_body(request, email, body, charset):
+    """Clean up a html part as best we can
+
+    Doesn't catch LXML errors
+    """
+    cleaned = _clean_html(request, body, charset, email["display_images"])
+    return _use_clean_html(request, email, cleaned)
+
+
+def _rendered_body_key(hashed, charset, display_images):
+    return hashlib.sha1(smart_bytes(u"{0}\n{1}\n{2}".format(hashed, charset, display_images))).hexdigest()
+
+
+def _render_html_part(request, email, part):
+    """Like `_clean_html_body`, but for a part
+
+    Bodies are deduplicated, so the cleaned HTML is cached by the body's hash
+    and shared between everyone who has a copy. HTML larger than
+    RENDERED_BODY_MAX_SIZE isn't cached.
+
+    Unless it's been pre-rendered, only the first HTML_MAX_SIZE bytes of a
+    body are cleaned and email["truncated"] is set. CSS isn't inlined for
+    bodies larger than HTML_CSS_MAX_SIZE.
+    """
+    key = _rendered_body_key(part.body.hashed, part.charset, email["display_images"])
+    cleaned = cache.get(key, version=RENDERED_BODY_CACHE_VERSION)
+
+    if cleaned is None:
+        rendered = RenderedBody.objects.filter(
+            body_id=part.body.id,
+            charset=part.charset,
+            display_images=email["display_images"],
+        ).first()
+
+        if rendered is not None:
+            cleaned = (rendered.html, rendered.has_images, rendered.css_failed)
+        else:
+            data = str(part.body.data)
+            inline_css = len(data) <= settings.HTML_CSS_MAX_SIZE
+            truncated = len(data) > settings.HTML_MAX_SIZE
+            if truncated:
+                # lxml copes with the unclosed tags left behind
+                data = data[:settings.HTML_MAX_SIZE]
+                email["truncated"] = True
+
+            cleaned = _clean_html(request, data, part.charset, email["display_images"], inline_css=inline_css)
+
+            if truncated:
+                # don't get in the way of the full version once it's been rendered
+                return _use_clean_html(request, email, cleaned)
+
+        if len(cleaned[0]) <= RENDERED_BODY_MAX_SIZE:
+            cache.set(key, cleaned, version=RENDERED_BODY_CACHE_VERSION)
+
+    return _use_clean_html(request, email, cleaned)
+
+
+def prerender_html_part(part):
+    """Clean up a html part with and without images, and store the results
+    for `_render_html_part`
+
+    Parts that lxml can't deal with are left for EmailView to sort out. As
+    with `_render_html_part`, CSS isn't inlined for bodies larger than
+    HTML_CSS_MAX_SIZE.
+    """
+    data = str(part.body.data)
+    inline_css = len(data) <= settings.HTML_CSS_MAX_SIZE
+    for display_images in (True, False):
+        rendered = RenderedBody.objects.filter(body_id=part.body.id, charset=part.charset,
+                                               display_images=display_images)
+        if rendered.exists():
+            continue
+
+        try:
+            cleaned = _clean_html(None, data, part.charset, display_images, inline_css=inline_css)
+            html, has_images, css_failed = cleaned
+        except (etree.LxmlError, ValueError):
+            return
+
+        try:
+            with transaction.atomic():
+                RenderedBody.objects.create(
+                    body_id=part.body.id,
+                    charset=part.charset,
+                    display_images=display_images,
+                    html=html,
+                    has_images=has_images,
+                    css_failed=css_failed,
+                )
+        except IntegrityError:
+            # another email with the same body got there first
+            pass
+
+
 def _render_body(request, email, attachments):
     """Updates `email` with the correct body
     """
@@ -185,7 +250,7 @@ def _render_body(request, email, attachments):
             body = u""
     else:
         try:
-            body = _clean_html_body(request, email, str(html.body.data), html.charset)
+            body = _render_html_part(request, email, html)
         except (etree.LxmlError, ValueError) as exc:
             if plain is not None and len(plain.body.data) > 0:
                 body = _unicode_damnit(plain.body.data, plain.charset)
@@ -205,6 +270,18 @@ def _render_body(request, email, attachments):
     return body
 
 
+def load_bodies(attachments):
+    """Load the data of every part that find_bodies might display, in one query
+
+    `attachments` should come from Email.get_parts, which doesn't load body
+    data. Everything else (e.g. images) is left alone.
+    """
+    parts = [part for part in attachments if part.is_leaf_node() and part.content_type in INLINE_CONTENT_TYPES]
+    bodies = Body.objects.in_bulk(set(part.body_id for part in parts))
+    for part in parts:
+        part.body = bodies[part.body_id]
+
+
 def find_bodies(request, email, attachments, depth=0):
     """Find bodies that should be inlined and add them to email["bodies"]
 
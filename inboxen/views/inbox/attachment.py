@@ -15,24 +15,63 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import calendar
 import re
 
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 from django.views import generic
 
 from braces.views import LoginRequiredMixin
+from sendfile import sendfile
 
 from inboxen import models
 
 HEADER_PARAMS = re.compile(r'([a-zA-Z0-9]+)=["\']?([^"\';=]+)["\']?[;]?')
 HEADER_CLEAN = re.compile(r'\s+')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
 
 __all__ = ["AttachmentDownloadView"]
 
 
+def parse_range(header, size):
+    """Parse a Range header with a single byte range
+
+    Returns a tuple of (start, stop), or None if the header should be ignored
+    (e.g. multiple ranges). Raises ValueError if the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if not last:
+            stop = size
+        elif int(last) < start:
+            # last byte before first byte, invalid
+            return None
+        else:
+            stop = min(int(last) + 1, size)
+    elif last:
+        # suffix range, the last `last` bytes
+        start = max(size - int(last), 0)
+        stop = size if int(last) > 0 else start
+    else:
+        return None
+
+    if start >= stop:
+        raise ValueError("Range not satisfiable")
+
+    return start, stop
+
+
 class AttachmentDownloadView(LoginRequiredMixin, generic.detail.BaseDetailView):
     def get_object(self):
-        qs = models.PartList.objects.select_related('body')
+        # body data is streamed by render_to_response
+        qs = models.PartList.objects.select_related('body', 'email').defer('body___data')
         qs = qs.filter(email__flags=~models.Email.flags.deleted)
 
         try:
@@ -41,6 +80,15 @@ class AttachmentDownloadView(LoginRequiredMixin, generic.detail.BaseDetailView):
             raise Http404
 
     def render_to_response(self, context):
+        # bodies are content addressed, so the hash makes a strong ETag
+        body = self.object.body
+        etag = quote_etag(body.hashed)
+        last_modified = calendar.timegm(self.object.email.received_date.utctimetuple())
+        if self.not_modified(body.hashed, last_modified):
+            response = HttpResponseNotModified()
+            self.set_cache_headers(response, etag, last_modified)
+            return response
+
         # build the Content-Disposition header
         disposition = ["attachment"]
 
@@ -67,14 +115,67 @@ class AttachmentDownloadView(LoginRequiredMixin, generic.detail.BaseDetailView):
             content_type = content_type[0]
 
         # make header object
-        data = self.object.body.data or ""
-        response = HttpResponse(
-            content=data,
-            status=200,
-        )
+        if body.path is not None:
+            # let the web server deal with ranges
+            response = sendfile(request=self.request, filename=body.path)
+            del response["Content-Encoding"]
+        else:
+            response = self.get_streaming_response(body, etag)
+
+        self.set_cache_headers(response, etag, last_modified)
 
-        response["Content-Length"] = self.object.body.size or len(data)
         response["Content-Disposition"] = HEADER_CLEAN.sub(" ", disposition)
         response["Content-Type"] = HEADER_CLEAN.sub(" ", content_type)
 
         return response
+
+    def not_modified(self, hashed, last_modified):
+        """Check If-None-Match, or If-Modified-Since if there isn't one"""
+        if_none_match = self.request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            etags = parse_etags(if_none_match)
+            return hashed in etags or "*" in etags
+
+        if_modified_since = self.request.META.get("HTTP_IF_MODIFIED_SINCE")
+        if if_modified_since is not None:
+            if_modified_since = parse_http_date_safe(if_modified_since)
+            return if_modified_since is not None and last_modified <= if_modified_since
+
+        return False
+
+    def set_cache_headers(self, response, etag, last_modified):
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        # attachments never change, but the user might lose access to them
+        patch_cache_control(response, private=True, no_cache=True)
+
+    def get_streaming_response(self, body, etag):
+        """Stream `body` from the database, or just the part of it asked for
+        by a Range header"""
+        size = body.size
+        if size is None:
+            size = len(body.data)
+
+        byte_range = None
+        range_header = self.request.META.get("HTTP_RANGE")
+        # only honour If-Range if it's for this body
+        if range_header is not None and self.request.META.get("HTTP_IF_RANGE", etag) == etag:
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = "bytes */{0}".format(size)
+                return response
+
+        if byte_range is None:
+            start, stop = 0, size
+            response = StreamingHttpResponse(body.iter_data(start, stop), status=200)
+        else:
+            start, stop = byte_range
+            response = StreamingHttpResponse(body.iter_data(start, stop), status=206)
+            response["Content-Range"] = "bytes {0}-{1}/{2}".format(start, stop - 1, size)
+
+        response["Content-Length"] = stop - start
+        response["Accept-Ranges"] = "bytes"
+
+        return response
@@ -17,18 +17,24 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import calendar
+import hashlib
 import logging
+import os
 
 from django.core.cache import cache
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseNotModified, HttpResponseRedirect
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import smart_bytes
+from django.utils.http import http_date, parse_etags, quote_etag
 from django.utils.translation import ugettext as _
 from django.views import generic
 
 from braces.views import LoginRequiredMixin
 from watson import search
 
-from inboxen import models
-from inboxen.utils.email import find_bodies
+from inboxen import models, tasks
+from inboxen.utils.email import find_bodies, load_bodies
 
 
 __all__ = ["EmailView"]
@@ -36,6 +42,10 @@ __all__ = ["EmailView"]
 
 _log = logging.getLogger(__name__)
 
+# stops the same email being queued for rendering over and over
+PRERENDER_PENDING_KEY = "prerender-pending-{0}"
+PRERENDER_PENDING_TIMEOUT = 60 * 5
+
 
 class EmailView(LoginRequiredMixin, generic.DetailView):
     model = models.Email
@@ -43,9 +53,21 @@ class EmailView(LoginRequiredMixin, generic.DetailView):
     template_name = 'inboxen/inbox/email.html'
 
     def get(self, *args, **kwargs):
+        self.object = self.get_object()
+
+        # emails don't change once they've been received, but how they're
+        # displayed depends on their flags and the user's profile
+        if_none_match = self.request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None and self.get_etag() in parse_etags(if_none_match):
+            out = HttpResponseNotModified()
+            self.set_cache_headers(out)
+            # browsers update their copy with the 304's headers
+            self.set_csp(out, self.get_display_images()[0])
+            return out
 
         with search.skip_index_update():
-            out = super(EmailView, self).get(*args, **kwargs)
+            context = self.get_context_data(object=self.object)
+            out = self.render_to_response(context)
             if "all-headers" in self.request.GET:
                 self.object.flags.view_all_headers = bool(int(self.request.GET["all-headers"]))
 
@@ -53,12 +75,55 @@ class EmailView(LoginRequiredMixin, generic.DetailView):
             self.object.flags.seen = True
             self.object.save(update_fields=["flags"])
 
+        # truncated HTML will change once it's been rendered in full
+        if not context["email"]["truncated"]:
+            self.set_cache_headers(out)
+
+        self.set_csp(out, getattr(self, "_has_images", False))
+        return out
+
+    def set_csp(self, response, display_images):
         # pretend to be @csp_replace
-        out._csp_replace = {"style-src": ["'self'", "'unsafe-inline'"]}
-        if getattr(self, "_has_images", False):
+        response._csp_replace = {"style-src": ["'self'", "'unsafe-inline'"]}
+        if display_images:
             # if we have images to display, allow loading over https
-            out._csp_replace["img-src"] = ["'self'", "https:"]
-        return out
+            response._csp_replace["img-src"] = ["'self'", "https:"]
+
+    def get_display_images(self):
+        """Returns a tuple of (display_images, ask_images)
+
+        Users with `ask_images` set in their profile can choose to display
+        images with the `imgDisplay` GET param
+        """
+        if "imgDisplay" in self.request.GET and int(self.request.GET["imgDisplay"]) == 1:
+            return True, False
+        elif self.request.user.inboxenprofile.flags.ask_images:
+            return False, True
+        else:
+            return bool(self.request.user.inboxenprofile.flags.display_images), False
+
+    def get_etag(self):
+        """Hash of everything that affects how this email is displayed
+
+        Expects `self.object` to have been saved with the flags it'll have the
+        next time it's viewed. The page's forms have a CSRF token that's tied
+        to the session, so that's included too.
+        """
+        etag = u"{0}:{1}:{2}:{3}:{4}:{5}".format(
+            self.object.id,
+            int(self.object.flags),
+            self.request.user.id,
+            int(self.request.user.inboxenprofile.flags),
+            os.environ.get("INBOXEN_COMMIT_ID", ""),
+            getattr(self.request, "csrf_token", ""),
+        )
+        return hashlib.sha1(smart_bytes(etag)).hexdigest()
+
+    def set_cache_headers(self, response):
+        """Browsers may keep a copy, but must check it's still valid"""
+        response["ETag"] = quote_etag(self.get_etag())
+        response["Last-Modified"] = http_date(calendar.timegm(self.object.received_date.utctimetuple()))
+        patch_cache_control(response, private=True, no_cache=True)
 
     def get_object(self, *args, **kwargs):
         # Convert the id from base 16 to 10
@@ -108,25 +173,24 @@ class EmailView(LoginRequiredMixin, generic.DetailView):
         email_dict["inbox"] = self.object.inbox
         email_dict["eid"] = self.object.eid
 
-        # GET params for users with `ask_image` set in their profile
-        if "imgDisplay" in self.request.GET and int(self.request.GET["imgDisplay"]) == 1:
-            email_dict["display_images"] = True
-            email_dict["ask_images"] = False
-        elif self.request.user.inboxenprofile.flags.ask_images:
-            email_dict["display_images"] = False
-            email_dict["ask_images"] = True
-        else:
-            email_dict["display_images"] = self.request.user.inboxenprofile.flags.display_images
-            email_dict["ask_images"] = False
+        email_dict["display_images"], email_dict["ask_images"] = self.get_display_images()
 
         # iterate over MIME parts
         attachments = self.object.get_parts()
+        load_bodies(attachments)
 
         email_dict["bodies"] = []
         email_dict["has_images"] = False
+        email_dict["truncated"] = False
 
         find_bodies(self.request, email_dict, attachments[:1])
 
+        # some HTML was too big to display, render it in the background if asked
+        if email_dict["truncated"] and "fullHtml" in self.request.GET:
+            if cache.add(PRERENDER_PENDING_KEY.format(self.object.id), True, PRERENDER_PENDING_TIMEOUT):
+                tasks.prerender_html.delay(self.object.id)
+            email_dict["full_pending"] = True
+
         for body in email_dict["bodies"]:
             assert isinstance(body, unicode), "body is %r" % type(body)
 
@@ -18,6 +18,7 @@
 ##
 
 from django.core.cache import cache
+from django.db import transaction
 from django.db.models import Case, Count, F, IntegerField, When
 from django.http import Http404, HttpResponseNotAllowed, HttpResponseRedirect
 from django.utils.translation import ugettext as _
@@ -26,7 +27,7 @@ from django.views import generic
 from braces.views import LoginRequiredMixin
 from watson import search
 
-from inboxen import models
+from inboxen import models, search_cache
 from inboxen.tasks import deal_with_flags
 from inboxen.tasks import delete_inboxen_item
 
@@ -56,6 +57,15 @@ class InboxView(LoginRequiredMixin, generic.ListView):
             qs = qs.order_by("-important", "-received_date").select_related("inbox", "inbox__domain")
         return qs
 
+    def clear_search_cache(self):
+        """Emails have been deleted, so search results may have changed
+
+        Waits for the transaction so a search can't cache results from before
+        the delete under the new generation
+        """
+        user_id = self.request.user.id
+        transaction.on_commit(lambda: search_cache.bump_generation(user_id))
+
     @search.skip_index_update()
     def post(self, *args, **kwargs):
         qs = self.get_queryset()
@@ -69,6 +79,7 @@ class InboxView(LoginRequiredMixin, generic.ListView):
                 raise Http404
 
             email.delete()
+            self.clear_search_cache()
 
             return HttpResponseRedirect(self.get_success_url())
         elif "important-single" in self.request.POST:
@@ -107,6 +118,7 @@ class InboxView(LoginRequiredMixin, generic.ListView):
             delete_task = delete_inboxen_item.chunks(email_ids, 500).group()
             delete_task.skew(step=50)
             delete_task.apply_async()
+            self.clear_search_cache()
 
         return HttpResponseRedirect(self.get_success_url())
 
@@ -17,17 +17,19 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
-import urllib
+import re
 
 from django import http
 from django.conf import settings
 from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils.http import urlencode
 from django.utils.translation import ugettext as _
 from django.views import generic
 
 from braces.views import LoginRequiredMixin
 
-from inboxen import tasks
+from inboxen import models, search, search_cache, tasks
 
 from celery import exceptions
 from celery.result import AsyncResult
@@ -35,13 +37,15 @@ from watson import models as watson_models
 
 __all__ = ["SearchView", "SearchApiView"]
 
+# generations are uuid4 hex, anything else could upset the cache backend
+GENERATION_RE = re.compile(r"^[0-9a-f]{32}$")
+
 
 class SearchView(LoginRequiredMixin, generic.ListView):
     """A specialised search view that splits results by model"""
     paginate_by = None
     template_name = "inboxen/user/search.html"
     filter_limit = 10
-    timeout = 1  # time to wait for results
     model = None  # will be useful later, honest!
 
     query_param = "q"
@@ -49,31 +53,43 @@ class SearchView(LoginRequiredMixin, generic.ListView):
 
     def get(self, request, *args, **kwargs):
         self.query = self.get_query(request)
+        try:
+            self.after = self.get_after(request)
+        except ValueError:
+            return http.HttpResponseBadRequest()
+        # always show up to date results, even if the URL is from a search
+        # that started before new mail arrived
+        self.generation = search_cache.get_generation(request.user.id)
+
         return super(SearchView, self).get(request, *args, **kwargs)
 
     def get_cache_key(self):
-        key = u"{0}-{1}".format(self.request.user.id, self.query)
-        return urllib.quote(key.encode("utf-8"))
+        return search_cache.get_cache_key(self.request.user.id, self.query, self.after, self.generation)
 
     def get_results(self):
         """Fetch result from either the cache or the queue
 
-        Raises TimeoutError if results aren't ready by self.timeout"""
-        result = cache.get(self.get_cache_key())
+        Raises TimeoutError if results aren't ready yet, this never waits for
+        the task"""
+        cache_key = self.get_cache_key()
+        result = cache.get(cache_key)
         if result is None or settings.CELERY_ALWAYS_EAGER:
-            search_task = tasks.search.apply_async(args=[self.request.user.id, self.query])
+            search_task = tasks.search.apply_async(args=[self.request.user.id, self.query, self.after, cache_key])
             result = {"task": search_task.id}
-            cache.set(self.get_cache_key(), result, tasks.SEARCH_TIMEOUT)
+            # don't clobber results if the task has already finished
+            cache.add(cache_key, result, tasks.SEARCH_PENDING_TIMEOUT)
         elif "task" in result:
             search_task = AsyncResult(result["task"])
         else:
             return result
 
-        result = search_task.get(self.timeout)
+        if not search_task.ready():
+            raise exceptions.TimeoutError
 
-        return result
+        return search_task.get()
 
     def get_queryset(self):
+        self.next_after = None
         if self.query == "":
             return {}
 
@@ -84,10 +100,14 @@ class SearchView(LoginRequiredMixin, generic.ListView):
             return {}
 
         queryset = {}
+        self.next_after = results.get("after")
 
         # some rubbish about not liking empty sets during IN statements :\
         if len(results["emails"]) > 0:
-            queryset["emails"] = watson_models.SearchEntry.objects.filter(id__in=results["emails"][:10]).prefetch_related("object")
+            email_ids = results["emails"]
+            emails = models.EmailSearch.objects.filter(email_id__in=email_ids).select_related("email", "inbox__domain")
+            # keep them in the order they were ranked
+            queryset["emails"] = sorted(emails, key=lambda result: email_ids.index(result.email_id))
         else:
             queryset["emails"] = []
 
@@ -101,6 +121,20 @@ class SearchView(LoginRequiredMixin, generic.ListView):
     def get_context_data(self, **kwargs):
         context = super(SearchView, self).get_context_data(**kwargs)
         context["query"] = self.query
+        context["after"] = self.after
+        context["next_after"] = self.next_after
+
+        params = {}
+        context["results_url"] = self.request.path
+        if self.after is not None:
+            params["after"] = self.after
+            context["results_url"] = "{0}?{1}".format(self.request.path, urlencode(params))
+
+        # polls must look for the same generation as us, new mail could
+        # arrive while we wait
+        params["generation"] = self.generation
+        poll_url = reverse("user-searchapi", kwargs={"q": self.query})
+        context["poll_url"] = "{0}?{1}".format(poll_url, urlencode(sorted(params.items())))
 
         # are we still waiting for results?
         if self.query == "":
@@ -118,21 +152,37 @@ class SearchView(LoginRequiredMixin, generic.ListView):
         kwarg_query = self.kwargs.get(self.get_query_param(), "").strip()
         return kwarg_query or get_query
 
+    def get_after(self, request):
+        """Cursor of the page of results to show, raises ValueError if it's
+        not valid
+        """
+        after = request.GET.get("after", "").strip()
+        if after == "":
+            return None
+
+        rank, email_id = search.parse_cursor(after)
+        return search.make_cursor(email_id, rank)
+
 
 class SearchApiView(SearchView):
-    """Check to see if a search is running or not"""
+    """Check to see if a page of search results is ready or not"""
     def get(self, request, *args, **kwargs):
         """Some WSGI implementations convert HEAD requests to GET requests.
 
         It's very annoying
         """
         self.query = self.get_query(request)
+        try:
+            self.after = self.get_after(request)
+        except ValueError:
+            return http.HttpResponseBadRequest()
+        self.generation = self.get_generation(request)
+
+        # only look at the cache and the result backend, so a poll never
+        # keeps a worker waiting
         result = cache.get(self.get_cache_key())
         if result is not None and "task" in result:
-            search_task = AsyncResult(result["task"])
-            try:
-                search_task.get(self.timeout)
-            except exceptions.TimeoutError:
+            if not AsyncResult(result["task"]).ready():
                 return http.HttpResponse(status=202)  # 202: still waiting for task
             return http.HttpResponse(status=201)  # 201: search results ready
         elif result is not None:
@@ -142,3 +192,12 @@ class SearchApiView(SearchView):
 
     def head(self, *args, **kwargs):
         return self.get(*args, **kwargs)
+
+    def get_generation(self, request):
+        """Search generation the results should come from, new mail might
+        have changed it since the search started"""
+        generation = request.GET.get("generation", "")
+        if GENERATION_RE.match(generation) is None:
+            return search_cache.get_generation(request.user.id)
+
+        return generation
@@ -20,20 +20,29 @@
 ##
 
 from datetime import datetime
+from functools import partial
 import logging
 
+from django.conf import settings
+from django.db import transaction
 from pytz import utc
-from watson import search
 
-from inboxen.models import Body, Email, Header, PartList
+from inboxen import lookup_cache, tasks
+from inboxen.models import Body, Email, Header, HeaderData, HeaderName, PartList
 
 
 log = logging.getLogger(__name__)
 
 
-@search.update_index()
 def make_email(message, inbox):
     """Push message to the database.
+
+    The whole message is parsed first so that bodies and headers can be looked
+    up and inserted in bulk, rather than a few queries per header. MPTT values
+    are calculated here too, so the part tree can be inserted in one go.
+
+    Indexing is left to `inboxen.tasks.index_emails` once the transaction has
+    been committed.
     """
     base = message.base
     received_date = datetime.now(utc)
@@ -41,28 +50,122 @@ def make_email(message, inbox):
     email = Email(inbox=inbox, received_date=received_date)
     email.save()
 
-    data = encode_body(base)
-    body, _ = Body.objects.only("id").get_or_create(data=data)
+    # the root part is the base of the message, everything else is in the
+    # order salmon walks the MIME tree, so parents always come before children
+    parts = [base]
+    parts.extend(message.walk())
+
+    # only keep one encoded body at a time, bodies that aren't in the database
+    # yet are encoded again when they're needed
+    bodies = {}
+    body_hashes = []
+    for part in parts:
+        hashed = Body.objects.hash_it(encode_body(part))
+        bodies[hashed] = partial(encode_body, part)
+        body_hashes.append(hashed)
+
+    header_names = set()
+    header_data = {}
+    part_headers = []
+    for part in parts:
+        headers = []
+        for name in part.keys():
+            data = part[name]
+            hashed = HeaderData.objects.hash_it(data)
+            header_names.add(name)
+            header_data[hashed] = data
+            headers.append((name, hashed))
+        part_headers.append(headers)
+
+    lookup_cache.check_generation()
+    body_ids = lookup_cache.bodies.get_or_create_many(Body.objects, bodies)
+    name_ids = lookup_cache.header_names.get_or_create_many(HeaderName.objects, header_names)
+    data_ids = lookup_cache.header_data.get_or_create_many(HeaderData.objects, header_data)
+
+    # work out the tree in Python so that the whole tree can be inserted at once
+    tree_id = PartList.objects.next_tree_id()
+    part_ids = dict(zip(parts, PartList.objects.next_ids(len(parts))))
+    tree = tree_values(parts)
+
+    part_items = []
+    headers = []
+    for part, hashed, headers_list in zip(parts, body_hashes, part_headers):
+        lft, rght, level = tree[part]
+        part_items.append(PartList(
+            id=part_ids[part],
+            body_id=body_ids[hashed],
+            email=email,
+            parent_id=None if part is base else part_ids[part.parent],
+            tree_id=tree_id,
+            lft=lft,
+            rght=rght,
+            level=level,
+        ))
+
+        for ordinal, (name, data_hash) in enumerate(headers_list):
+            headers.append(Header(
+                name_id=name_ids[name],
+                data_id=data_ids[data_hash],
+                ordinal=ordinal,
+                part_id=part_ids[part],
+            ))
+
+    PartList.objects.bulk_create(part_items)
+    Header.objects.bulk_create(headers)
+
+    email_id = email.id
+    transaction.on_commit(lambda: queue_index(email_id))
+    if settings.PRERENDER_HTML:
+        transaction.on_commit(lambda: queue_prerender(email_id))
+
+
+def queue_index(email_id):
+    """Ask Celery to index an email
+
+    If this fails the email can still be found by `manage.py search_backlog`
+    """
+    try:
+        tasks.index_emails.delay([email_id])
+    except Exception:
+        log.exception("Couldn't queue email %s for indexing", email_id)
+
 
-    part = PartList(body=body, email=email)
-    part.save()
+def queue_prerender(email_id):
+    """Ask Celery to clean up HTML bodies of an email
 
-    parents = {base: part.id}
+    If this fails the bodies are cleaned up when the email is viewed
+    """
+    try:
+        tasks.prerender_html.delay(email_id)
+    except Exception:
+        log.exception("Couldn't queue email %s for prerendering", email_id)
 
-    for header in message.keys():
-        ordinal = message.keys().index(header)
-        Header.objects.create(name=header, data=message[header], ordinal=ordinal, part=part)
 
-    for part in message.walk():
-        data = encode_body(part)
-        body, _ = Body.objects.only("id").get_or_create(data=data)
-        part_item = PartList(body=body, email=email, parent_id=parents[part.parent])
-        part_item.save()
-        parents[part] = part_item.id
+def tree_values(parts):
+    """Calculate MPTT values for a list of parts
 
-        for header in part.keys():
-            ordinal = part.keys().index(header)
-            Header.objects.create(name=header, data=part[header], ordinal=ordinal, part=part_item)
+    `parts` must start with the root part and be in the order salmon walks
+    the MIME tree (i.e. pre-order). Returns a dict of part -> (lft, rght, level)
+    """
+    levels = {}
+    sizes = {}
+    for part in parts:
+        levels[part] = 0 if part is parts[0] else levels[part.parent] + 1
+        sizes[part] = 1
+
+    # count descendants, children always come after their parents
+    for part in reversed(parts[1:]):
+        sizes[part.parent] += sizes[part]
+
+    values = {}
+    for idx, part in enumerate(parts):
+        # every part before this one has been entered, and all but our
+        # ancestors have been left too
+        lft = 2 * idx - levels[part] + 1
+        rght = lft + 2 * sizes[part] - 1
+        values[part] = (lft, rght, levels[part])
+
+    return values
 
 
 def encode_body(part):
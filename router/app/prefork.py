@@ -0,0 +1,71 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Run more than one router process on the same socket
+
+The listening socket is opened once and then inherited by forked workers, so
+this works for both TCP and UNIX sockets. The kernel hands each connection to
+whichever worker accepts it first.
+"""
+
+import logging
+import os
+
+from django.core.cache import caches
+from django.db import connections
+
+WORKER_PIDFILE = "run/router-{0}.pid"
+
+log = logging.getLogger(__name__)
+
+
+class PreforkReceiver(object):
+    """Start `workers` processes, each running the receiver made by `factory`
+
+    The receiver isn't created until `start` is called, so nothing listens on
+    the socket unless this is the receiver Salmon actually starts.
+
+    The process Salmon started is worker 0 and uses Salmon's pidfile, the
+    others write their pid to WORKER_PIDFILE.
+    """
+    def __init__(self, factory, workers=1):
+        self.factory = factory
+        self.workers = workers
+        self.receiver = None
+
+    def start(self):
+        self.receiver = self.factory()
+
+        # children must not share database or cache connections with their
+        # parent, so close them and let each process open its own
+        for connection in connections.all():
+            connection.close()
+        for cache in caches.all():
+            cache.close()
+
+        for worker in range(1, self.workers):
+            pid = os.fork()
+            if pid == 0:
+                with open(WORKER_PIDFILE.format(worker), "w") as pidfile:
+                    pidfile.write(str(os.getpid()))
+                break
+        else:
+            worker = 0
+
+        log.info("Router worker %s started with pid %s", worker, os.getpid())
+        self.receiver.start()
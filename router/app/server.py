@@ -26,10 +26,12 @@ from salmon.server import SMTPError, Relay
 
 from django.conf import settings
 from django.db import DatabaseError, transaction
-from watson import search
+from django.db.models import F
 
 from app.helpers import make_email
-from inboxen.models import Inbox
+from app.spool import Spool
+from inboxen import recipient_cache
+from inboxen.models import Inbox, UserProfile
 from inboxen.utils import RESERVED_LOCAL_PARTS_REGEX
 
 # we want to match *something*, but not something consumed by forward_to_admins
@@ -53,26 +55,61 @@ def forward_to_admins(message, local=None, domain=None):
 @route(r"(inbox)@(domain)", inbox=INBOX_REGEX, domain=r".+")
 @stateless
 @nolocking
-@transaction.atomic()
 def process_message(message, inbox=None, domain=None):
     try:
-        inbox = Inbox.objects.filter(inbox=inbox, domain__domain=domain)
-        inbox = inbox.select_related("user", "user__inboxenprofile").receiving()
-        inbox = inbox.get()
-
-        make_email(message, inbox)
-
-        with search.skip_index_update():
-            inbox.flags.new = True
-            inbox.save(update_fields=["flags"])
+        if not recipient_cache.is_receiving(inbox, domain):
+            raise Inbox.DoesNotExist
 
-        if not inbox.flags.exclude_from_unified:
-            profile = inbox.user.inboxenprofile
-            profile.flags.unified_has_new_messages = True
-            profile.save(update_fields=["flags"])
+        if settings.ROUTER_SPOOL:
+            # config.spool does the rest
+            get_spool().push(message, inbox, domain)
+        else:
+            deliver(message, inbox, domain)
 
     except DatabaseError, e:
         log.exception("DB error: %s", e)
         raise SMTPError(451, "Error processing message, try again later.")
+    except (IOError, OSError), e:
+        log.exception("Spool error: %s", e)
+        raise SMTPError(451, "Error processing message, try again later.")
     except Inbox.DoesNotExist:
         raise SMTPError(550, "No such address")
+
+
+@transaction.atomic()
+def deliver(message, inbox=None, domain=None):
+    """Save `message` to the database
+
+    Raises Inbox.DoesNotExist if the inbox can't receive email
+    """
+    inbox = Inbox.objects.filter(inbox=inbox, domain__domain=domain)
+    inbox = inbox.receiving().get()
+
+    make_email(message, inbox)
+
+    # only write to rows where the flag isn't already set, otherwise a burst
+    # of mail to one inbox updates the same rows over and over
+    Inbox.objects.filter(id=inbox.id, flags=~Inbox.flags.new).update(flags=F("flags").bitor(Inbox.flags.new))
+
+    if not inbox.flags.exclude_from_unified:
+        unified_new = UserProfile.flags.unified_has_new_messages
+        updated = UserProfile.objects.filter(user_id=inbox.user_id, flags=~unified_new).update(
+            flags=F("flags").bitor(unified_new))
+
+        if updated == 0:
+            # either the flag is already set or the profile hasn't been created yet
+            profile, created = UserProfile.objects.get_or_create(user_id=inbox.user_id)
+            if created:
+                profile.flags.unified_has_new_messages = True
+                profile.save(update_fields=["flags"])
+
+
+_spool = None
+
+
+def get_spool():
+    global _spool
+    if _spool is None:
+        _spool = Spool()
+
+    return _spool
@@ -0,0 +1,208 @@
+##
+#    Copyright (C) 2017 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+"""Spool messages to disk so the MTA doesn't have to wait for the database
+
+`process_message` pushes accepted messages onto a Salmon queue (a Maildir),
+along with their envelope. `SpoolReceiver` is started by config.spool and
+delivers them to the database with a pool of worker threads.
+
+Workers claim a message by moving it from "new" to "cur", which is atomic, so
+only one worker will ever process a given message. Messages that can't be
+delivered (or read) are moved to the failed queue.
+
+Messages are written to "tmp", fsynced and then renamed into "new", and the
+directory is fsynced before the MTA is told we have the message.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from salmon import queue
+from salmon.mail import MailRequest
+
+from inboxen.models import Inbox
+
+SPOOL_PATH = "run/spool"
+FAILED_PATH = "run/spool-failed"
+
+log = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """A Salmon queue that remembers which inbox each message was for"""
+    def __init__(self, path=SPOOL_PATH, failed_path=FAILED_PATH):
+        self.queue = queue.Queue(path)
+        self.failed = queue.Queue(failed_path)
+
+    def _path(self, directory, key):
+        return os.path.join(self.queue.dir, directory, key)
+
+    def push(self, message, inbox, domain):
+        """Durably store `message`, returns its key"""
+        envelope = {
+            "peer": message.Peer,
+            "from": message.From,
+            "to": message.To,
+            "inbox": inbox,
+            "domain": domain,
+        }
+        data = "{0}\n{1}".format(json.dumps(envelope), message.original)
+        key = "{0}.{1}".format(int(time.time()), uuid.uuid4().hex)
+
+        tmp_path = self._path("tmp", key)
+        try:
+            with open(tmp_path, "wb") as msg_file:
+                msg_file.write(data)
+                msg_file.flush()
+                os.fsync(msg_file.fileno())
+            os.rename(tmp_path, self._path("new", key))
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        self._fsync_dir("new")
+        return key
+
+    def _fsync_dir(self, directory):
+        """Make sure renames into `directory` have hit the disk"""
+        fd = os.open(os.path.join(self.queue.dir, directory), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def count(self):
+        return self.queue.count()
+
+    def claim(self):
+        """Yield (key, message, inbox, domain) for messages in the spool
+
+        Messages claimed by another worker are skipped
+        """
+        for key in os.listdir(os.path.join(self.queue.dir, "new")):
+            try:
+                os.rename(self._path("new", key), self._path("cur", key))
+            except OSError:
+                continue
+
+            try:
+                with open(self._path("cur", key)) as msg_file:
+                    envelope, data = msg_file.read().split("\n", 1)
+
+                envelope = json.loads(envelope)
+                message = MailRequest(envelope["peer"], envelope["from"], envelope["to"], data)
+                inbox, domain = envelope["inbox"], envelope["domain"]
+            except Exception:
+                # don't let one bad file kill the worker
+                log.exception("Error reading %s, moving it to failed queue", key)
+                self.fail(key)
+                continue
+
+            yield key, message, inbox, domain
+
+    def remove(self, key):
+        """Remove a claimed message"""
+        os.unlink(self._path("cur", key))
+
+    def fail(self, key):
+        """Move a claimed message to the failed queue"""
+        os.rename(self._path("cur", key), os.path.join(self.failed.dir, "new", key))
+
+    def recover(self):
+        """Put claimed messages back into the spool
+
+        Only call this when no workers are running, e.g. if one was killed
+        while it was processing a message
+        """
+        for key in os.listdir(os.path.join(self.queue.dir, "cur")):
+            os.rename(self._path("cur", key), self._path("new", key))
+
+
+class SpoolReceiver(object):
+    """Deliver spooled messages with `handler`
+
+    `handler` is called as `handler(message, inbox, domain)` and should raise
+    Inbox.DoesNotExist if the inbox has gone away since the message was
+    accepted. Database errors are retried `retries` times, backing off
+    exponentially.
+    """
+    def __init__(self, handler, spool=None, workers=None, retries=None, sleep=1):
+        self.handler = handler
+        self.spool = spool or Spool()
+        self.workers = settings.ROUTER_SPOOL_WORKERS if workers is None else workers
+        self.retries = settings.ROUTER_SPOOL_RETRIES if retries is None else retries
+        self.sleep = sleep
+
+    def start(self, one_shot=False):
+        """Start worker threads, or process the spool once if `one_shot` is True"""
+        log.info("Spool receiver started on %s with %s workers", self.spool.queue.dir, self.workers)
+        self.spool.recover()
+
+        if one_shot:
+            self.run(one_shot=True)
+            return
+
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.run, name="spool-worker-{0}".format(i))
+            worker.start()
+
+    def run(self, one_shot=False):
+        while True:
+            processed = 0
+            for key, message, inbox, domain in self.spool.claim():
+                self.process_message(key, message, inbox, domain)
+                processed += 1
+
+            if one_shot:
+                return
+            elif processed == 0:
+                time.sleep(self.sleep)
+
+    def process_message(self, key, message, inbox, domain):
+        for attempt in range(self.retries + 1):
+            try:
+                self.handler(message, inbox, domain)
+            except Inbox.DoesNotExist:
+                log.warning("Inbox %s@%s has gone away, moving %s to failed queue", inbox, domain, key)
+                self.spool.fail(key)
+                return
+            except DatabaseError, e:
+                log.warning("DB error on attempt %s for %s: %s", attempt + 1, key, e)
+                # the connection may well be broken, get a fresh one
+                connection.close()
+                if attempt < self.retries:
+                    time.sleep(2 ** attempt)
+            except Exception:
+                # don't let one bad message kill the worker
+                log.exception("Error delivering %s, moving it to failed queue", key)
+                self.spool.fail(key)
+                return
+            else:
+                self.spool.remove(key)
+                return
+
+        log.error("Giving up on %s, moving it to failed queue", key)
+        self.spool.fail(key)
@@ -6,14 +6,22 @@ from salmon.server import SMTPReceiver, LMTPReceiver
 sys.path.append('..')
 os.environ['DJANGO_SETTINGS_MODULE'] = 'inboxen.settings'
 
-from django.conf import settings
-import django
+# Django has to be set up before anything that uses models is imported
+from django.conf import settings  # noqa: E402
+import django  # noqa: E402
 
 django.setup()
 
-# where to listen for incoming messages
-if settings.SALMON_SERVER["type"] == "lmtp":
-    receiver = LMTPReceiver(socket=settings.SALMON_SERVER["path"])
-elif settings.SALMON_SERVER["type"] == "smtp":
-    receiver = SMTPReceiver(settings.SALMON_SERVER['host'],
+from app.prefork import PreforkReceiver  # noqa: E402
+
+
+def make_receiver():
+    """Where to listen for incoming messages"""
+    if settings.SALMON_SERVER["type"] == "lmtp":
+        return LMTPReceiver(socket=settings.SALMON_SERVER["path"])
+    elif settings.SALMON_SERVER["type"] == "smtp":
+        return SMTPReceiver(settings.SALMON_SERVER['host'],
                             settings.SALMON_SERVER['port'])
+
+
+receiver = PreforkReceiver(make_receiver, settings.ROUTER_WORKERS)
@@ -18,21 +18,24 @@
 ##
 
 import mock
+import os
 import shutil
 import sys
 
 from django import test
 from django.contrib.auth import get_user_model
-from django.db import DatabaseError
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
 
 from salmon.mail import MailRequest
 from salmon.server import SMTPError
 from salmon.routing import Router
 
 from inboxen.utils import override_settings
-from inboxen import models
+from inboxen import models, recipient_cache, search
 from inboxen.tests import factories
-from router.app.helpers import make_email
+from router.app.helpers import encode_body, make_email
 
 
 TEST_MSG = """From: Test <test@localhost>
@@ -84,6 +87,7 @@ BODIES = [
 class RouterTestCase(test.TestCase):
     def setUp(self):
         sys.path.append("router")
+        cache.clear()
 
     def tearDown(self):
         sys.path.pop()
@@ -105,11 +109,48 @@ class RouterTestCase(test.TestCase):
             process_message(None, None, None)
         self.assertEqual(error.exception.code, 550)
 
+        # None@None is now known not to exist
+        cache.clear()
+
         with self.assertRaises(SMTPError) as error, \
                 mock.patch.object(models.Inbox.objects, "filter", side_effect=DatabaseError):
             process_message(None, None, None)
         self.assertEqual(error.exception.code, 451)
 
+    def test_recipient_cache(self):
+        from router.app.server import process_message
+
+        inbox = factories.InboxFactory()
+
+        with self.assertRaises(SMTPError) as error:
+            process_message(None, "notaninbox", inbox.domain.domain)
+        self.assertEqual(error.exception.code, 550)
+
+        with self.assertNumQueries(0), self.assertRaises(SMTPError) as error:
+            process_message(None, "notaninbox", inbox.domain.domain)
+        self.assertEqual(error.exception.code, 550)
+
+        self.assertTrue(recipient_cache.is_receiving(inbox.inbox, inbox.domain.domain))
+        with self.assertNumQueries(0):
+            self.assertTrue(recipient_cache.is_receiving(inbox.inbox, inbox.domain.domain))
+
+        # saving an inbox updates the cache
+        with mock.patch("inboxen.signals.transaction.on_commit", lambda func: func()):
+            inbox.flags.disabled = True
+            inbox.save()
+        with self.assertNumQueries(0):
+            self.assertFalse(recipient_cache.is_receiving(inbox.inbox, inbox.domain.domain))
+
+        # and domains clear it
+        with mock.patch("inboxen.signals.transaction.on_commit", lambda func: func()):
+            inbox.domain.save()
+        with self.assertNumQueries(1):
+            self.assertFalse(recipient_cache.is_receiving(inbox.inbox, inbox.domain.domain))
+
+        with override_settings(ROUTER_RECIPIENT_CACHE_TIMEOUT=0), self.assertNumQueries(2):
+            self.assertFalse(recipient_cache.is_receiving(inbox.inbox, inbox.domain.domain))
+            self.assertFalse(recipient_cache.is_receiving(inbox.inbox, inbox.domain.domain))
+
     def test_flag_setting(self):
         # import here, that way we don't have to fiddle with sys.path in the global scope
         from router.app.server import process_message
@@ -157,6 +198,235 @@ class RouterTestCase(test.TestCase):
         bodies = [str(part.body.data) for part in models.PartList.objects.select_related("body").order_by("level", "lft")]
         self.assertEqual(bodies, BODIES)
 
+    def test_make_email_queues_index(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+
+        with mock.patch("router.app.helpers.transaction.on_commit", lambda func: func()), \
+                mock.patch("router.app.helpers.tasks.index_emails.delay") as delay_mock:
+            make_email(message, inbox)
+
+        email = models.Email.objects.get()
+        delay_mock.assert_called_once_with([email.id])
+        # indexing is left to the task
+        self.assertEqual(list(search.unindexed_emails()), [email])
+
+        # a broken broker shouldn't stop delivery
+        with mock.patch("router.app.helpers.transaction.on_commit", lambda func: func()), \
+                mock.patch("router.app.helpers.tasks.index_emails.delay", side_effect=IOError):
+            make_email(message, inbox)
+        self.assertEqual(models.Email.objects.count(), 2)
+
+    @override_settings(PRERENDER_HTML=True)
+    def test_make_email_queues_prerender(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+
+        with mock.patch("router.app.helpers.transaction.on_commit", lambda func: func()), \
+                mock.patch("router.app.helpers.tasks.index_emails.delay"), \
+                mock.patch("router.app.helpers.tasks.prerender_html.delay") as delay_mock:
+            make_email(message, inbox)
+
+        delay_mock.assert_called_once_with(models.Email.objects.get().id)
+
+    @override_settings(BODY_CHUNK_SIZE=4)
+    def test_make_email_chunked(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+
+        make_email(message, inbox)
+        make_email(message, inbox)
+        self.assertEqual(models.Email.objects.count(), 2)
+        self.assertEqual(models.Body.objects.count(), len(set(BODIES)))
+
+        bodies = models.PartList.objects.select_related("body").filter(email=models.Email.objects.latest("id"))
+        bodies = [str(part.body.data) for part in bodies.order_by("level", "lft")]
+        self.assertEqual(bodies, BODIES)
+
+        for body in models.Body.objects.all():
+            self.assertEqual(body.hashed, models.Body.objects.hash_it(str(body.data)))
+            self.assertEqual(body.size, len(body.data))
+
+    def test_make_email_encodes_missing_bodies(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+        make_email(message, inbox)
+
+        with mock.patch("router.app.helpers.encode_body", wraps=encode_body) as encode_mock:
+            make_email(message, inbox)
+        # every body is already in the database, so they're only encoded to be hashed
+        self.assertEqual(encode_mock.call_count, len(BODIES))
+
+    def test_make_email_tree(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+        make_email(message, inbox)
+        make_email(message, inbox)
+
+        fields = ("id", "parent_id", "lft", "rght", "level")
+        parts = list(models.PartList.objects.order_by("id").values_list(*fields))
+        self.assertEqual(models.PartList.objects.filter(parent__isnull=True).values("tree_id").distinct().count(), 2)
+
+        # django-mptt should agree with the values we calculated
+        models.PartList.objects.rebuild()
+        self.assertEqual(list(models.PartList.objects.order_by("id").values_list(*fields)), parts)
+
+    def test_make_email_dedup(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+
+        make_email(message, inbox)
+        body_count = models.Body.objects.count()
+        name_count = models.HeaderName.objects.count()
+        data_count = models.HeaderData.objects.count()
+        header_count = models.Header.objects.count()
+
+        make_email(message, inbox)
+        self.assertEqual(models.Email.objects.count(), 2)
+        self.assertEqual(models.PartList.objects.count(), 12)
+        self.assertEqual(models.Body.objects.count(), body_count)
+        self.assertEqual(models.HeaderName.objects.count(), name_count)
+        self.assertEqual(models.HeaderData.objects.count(), data_count)
+        self.assertEqual(models.Header.objects.count(), header_count * 2)
+
+        email = models.Email.objects.latest("id")
+        headers = models.Header.objects.filter(part__email=email, part__parent=None).order_by("ordinal")
+        self.assertEqual([h.name.name for h in headers], message.keys())
+
+    def test_make_email_query_count(self):
+        inbox = factories.InboxFactory()
+        extra_headers = "".join(["X-Extra-%d: %d\n" % (i, i) for i in range(50)])
+
+        few_message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+        many_message = MailRequest("locahost", "test@localhost", str(inbox), extra_headers + TEST_MSG)
+
+        # make sure names, data and bodies already exist so both messages take the same path
+        make_email(few_message, inbox)
+        make_email(many_message, inbox)
+
+        with CaptureQueriesContext(connection) as few_headers:
+            make_email(few_message, inbox)
+
+        with CaptureQueriesContext(connection) as many_headers:
+            make_email(many_message, inbox)
+
+        self.assertEqual(len(few_headers), len(many_headers))
+
+    def test_spool(self):
+        from router.app.server import deliver, process_message
+        from router.app.spool import Spool, SpoolReceiver
+
+        inbox = factories.InboxFactory()
+        spool = Spool("run/spool", "run/spool-failed")
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+
+        with override_settings(ROUTER_SPOOL=True), \
+                mock.patch("router.app.server.get_spool", return_value=spool):
+            process_message(message, inbox.inbox, inbox.domain.domain)
+
+            with self.assertRaises(SMTPError) as error:
+                process_message(message, "notaninbox", inbox.domain.domain)
+            self.assertEqual(error.exception.code, 550)
+
+        self.assertEqual(models.Email.objects.count(), 0)
+        self.assertEqual(spool.count(), 1)
+
+        receiver = SpoolReceiver(deliver, spool=spool, workers=1, retries=0)
+        receiver.start(one_shot=True)
+
+        self.assertEqual(models.Email.objects.count(), 1)
+        self.assertEqual(models.PartList.objects.count(), 6)
+        self.assertEqual(spool.count(), 0)
+        self.assertEqual(spool.failed.count(), 0)
+
+    def test_spool_retries(self):
+        from router.app.spool import Spool, SpoolReceiver
+
+        spool = Spool("run/spool", "run/spool-failed")
+        message = MailRequest("locahost", "test@localhost", "someone@example.com", TEST_MSG)
+        spool.push(message, "someone", "example.com")
+
+        handler = mock.Mock(side_effect=DatabaseError)
+        receiver = SpoolReceiver(handler, spool=spool, workers=1, retries=2)
+
+        with mock.patch("router.app.spool.time.sleep") as sleep_mock, \
+                mock.patch("router.app.spool.connection"):
+            receiver.start(one_shot=True)
+
+        self.assertEqual(handler.call_count, 3)
+        self.assertEqual(handler.call_args[0][0].To, "someone@example.com")
+        self.assertEqual(handler.call_args[0][1:], ("someone", "example.com"))
+        self.assertEqual([call[0][0] for call in sleep_mock.call_args_list], [1, 2])
+        self.assertEqual(spool.count(), 0)
+        self.assertEqual(spool.failed.count(), 1)
+
+        # inboxes that have gone away go straight to the failed queue
+        spool.push(message, "someone", "example.com")
+        handler = mock.Mock(side_effect=models.Inbox.DoesNotExist)
+        receiver = SpoolReceiver(handler, spool=spool, workers=1, retries=2)
+        receiver.start(one_shot=True)
+
+        self.assertEqual(handler.call_count, 1)
+        self.assertEqual(spool.count(), 0)
+        self.assertEqual(spool.failed.count(), 2)
+
+    def test_spool_push(self):
+        from router.app.spool import Spool
+
+        spool = Spool("run/spool", "run/spool-failed")
+        message = MailRequest("locahost", "test@localhost", "someone@example.com", TEST_MSG)
+
+        with mock.patch("router.app.spool.os.fsync", wraps=os.fsync) as fsync_mock:
+            key = spool.push(message, "someone", "example.com")
+
+        # the message file and the directory
+        self.assertEqual(fsync_mock.call_count, 2)
+        self.assertEqual(os.listdir("run/spool/new"), [key])
+        self.assertEqual(os.listdir("run/spool/tmp"), [])
+
+    def test_spool_bad_file(self):
+        from router.app.spool import Spool, SpoolReceiver
+
+        spool = Spool("run/spool", "run/spool-failed")
+        with open("run/spool/new/1.bad", "w") as msg_file:
+            msg_file.write("not an envelope")
+
+        handler = mock.Mock()
+        receiver = SpoolReceiver(handler, spool=spool, workers=1, retries=0)
+        receiver.start(one_shot=True)
+
+        self.assertEqual(handler.call_count, 0)
+        self.assertEqual(spool.count(), 0)
+        self.assertEqual(spool.failed.count(), 1)
+
+    def test_prefork(self):
+        from router.app.prefork import PreforkReceiver
+
+        os.mkdir("run")
+        receiver = mock.Mock()
+        prefork = PreforkReceiver(lambda: receiver, workers=3)
+
+        with mock.patch("router.app.prefork.connections") as connections_mock, \
+                mock.patch("router.app.prefork.os.fork", return_value=1234) as fork_mock:
+            connections_mock.all.return_value = [mock.Mock()]
+            prefork.start()
+
+            self.assertEqual(fork_mock.call_count, 2)
+            self.assertEqual(receiver.start.call_count, 1)
+            self.assertEqual(connections_mock.all.return_value[0].close.call_count, 1)
+            self.assertFalse(os.path.exists("run/router-1.pid"))
+
+        # in the first child
+        receiver.reset_mock()
+        with mock.patch("router.app.prefork.connections"), \
+                mock.patch("router.app.prefork.os.fork", return_value=0) as fork_mock:
+            prefork.start()
+
+            self.assertEqual(fork_mock.call_count, 1)
+            self.assertEqual(receiver.start.call_count, 1)
+            with open("run/router-1.pid") as pidfile:
+                self.assertEqual(pidfile.read(), str(os.getpid()))
+
     @override_settings(ADMINS=(("admin", "root@localhost"),))
     def test_forwarding(self):
         from router.app.server import forward_to_admins
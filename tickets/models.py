@@ -22,9 +22,9 @@ from django.db import models
 from django.utils import safestring
 from django.utils.translation import ugettext_lazy as _
 
-from lxml.html.clean import Cleaner
 import markdown
 
+from inboxen.clean import ticket_cleaner
 from tickets import managers
 
 
@@ -33,14 +33,8 @@ class RenderBodyMixin(object):
         if not self.body:
             return ""
 
-        cleaner = Cleaner(
-            allow_tags=["p", "a", "i", "b", "em", "strong", "ol", "ul", "li", "pre", "code"],
-            safe_attrs=["href"],
-            remove_unknown_tags=False,
-            safe_attrs_only=True,
-        )
         body = markdown.markdown(self.body)
-        body = cleaner.clean_html(body)
+        body = ticket_cleaner.clean_html(body)
         return safestring.mark_safe(body)
 
 